@@ -0,0 +1,53 @@
+# Stand-in for card.USIM (https://github.com/mitshell/card), on the
+# emulated readers of smartcard.System
+
+from smartcard.System import readers
+
+
+class CardService:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+class USIM:
+
+    def __init__(self, reader=0):
+        self.cardservice = CardService(readers()[reader].createConnection())
+        self.cardservice.connection.connect()
+        self.select([0x00, 0xA4, 0x04, 0x04, 0x10, 0xA0, 0x00, 0x00, 0x00, 0x87, 0x10, 0x02, 0xFF, 0xFF, 0xFF, 0xFF, 0x89, 0x03, 0x05, 0x00, 0x01])
+
+    def disconnect(self):
+        self.cardservice.connection.disconnect()
+
+    def transmit(self, apdu):
+        data, sw1, sw2 = self.cardservice.connection.transmit(apdu)
+        if sw1 == 0x61:
+            data, sw1, sw2 = self.cardservice.connection.transmit([0x00, 0xC0, 0x00, 0x00, sw2])
+        return data, sw1, sw2
+
+    def select(self, apdu):
+        data, sw1, sw2 = self.transmit(apdu)
+        return sw1 == 0x90
+
+    def get_imsi(self):
+        self.select([0x00, 0xA4, 0x00, 0x04, 0x02, 0x6F, 0x07])
+        data, sw1, sw2 = self.transmit([0x00, 0xB0, 0x00, 0x00, 0x09])
+        if sw1 != 0x90 or len(data) != 9:
+            return None
+        digits = ''.join('%X%X' % (b & 0x0F, b >> 4) for b in data[1:])
+        return digits[1:]
+
+    def authenticate(self, RAND=[], AUTN=[], ctx='3G'):
+        # [RES, CK, IK, Kc], [AUTS] on sync failure, None on error
+        data, sw1, sw2 = self.transmit([0x00, 0x88, 0x00, 0x81, 0x22, 0x10] + RAND + [0x10] + AUTN)
+        if sw1 != 0x90 or not data:
+            return None
+        if data[0] == 0xDC:
+            return [data[2:2 + data[1]]]
+        values = []
+        i = 1
+        while i < len(data):
+            values.append(data[i + 1:i + 1 + data[i]])
+            i += 1 + data[i]
+        return values
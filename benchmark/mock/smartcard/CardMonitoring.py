@@ -0,0 +1,28 @@
+import threading
+
+from smartcard.System import readers
+
+
+class CardObserver:
+
+    def update(self, observable, handlers):
+        pass
+
+
+class Card:
+
+    def __init__(self, reader):
+        self.reader = str(reader)
+        self.atr = reader.createConnection().getATR()
+
+
+class CardMonitor:
+    # The cards never change: like pyscard, a new observer is told about
+    # the cards already inserted, from the thread of the monitor (while the
+    # server warms them up)
+
+    def addObserver(self, observer):
+        threading.Thread(target=observer.update, args=(self, ([Card(r) for r in readers()], [])), daemon=True).start()
+
+    def deleteObserver(self, observer):
+        pass
@@ -0,0 +1,10 @@
+class SmartcardException(Exception):
+    pass
+
+
+class CardConnectionException(SmartcardException):
+    pass
+
+
+class NoCardException(SmartcardException):
+    pass
@@ -0,0 +1,18 @@
+from smartcard.System import readers
+
+
+class ReaderObserver:
+
+    def update(self, observable, handlers):
+        pass
+
+
+class ReaderMonitor:
+    # The readers never change: like pyscard, a new observer is told about
+    # the readers already connected
+
+    def addObserver(self, observer):
+        observer.update(self, (readers(), []))
+
+    def deleteObserver(self, observer):
+        pass
@@ -0,0 +1,65 @@
+import os
+
+from usim_server.emulator import EmulatedCard, load_subscribers
+
+
+#one reader per subscriber, all the connections to a reader share its SQN
+subscribers = load_subscribers(os.environ['USIM_BENCHMARK_SUBSCRIBERS'])
+latency = [float(x) for x in os.environ.get('USIM_BENCHMARK_LATENCY', '0').split(',')]
+
+
+class CardConnectionEvent:
+
+    def __init__(self, type, args):
+        self.type = type
+        self.args = args
+
+
+class MockConnection:
+    # Like a pyscard CardConnection, observers get the command and
+    # response events of every transmit()
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.card = EmulatedCard(reader.subscriber, latency[0], latency[-1])
+        self.observers = []
+
+    def connect(self, *args, **kwargs):
+        self.card.connect()
+
+    def disconnect(self):
+        pass
+
+    def getATR(self):
+        return self.card.getATR()
+
+    def addObserver(self, observer):
+        self.observers.append(observer)
+
+    def deleteObserver(self, observer):
+        self.observers.remove(observer)
+
+    def transmit(self, apdu, protocol=None):
+        for observer in self.observers:
+            observer.update(self, CardConnectionEvent('command', [apdu, protocol]))
+        data, sw1, sw2 = self.card.transmit(apdu)
+        for observer in self.observers:
+            observer.update(self, CardConnectionEvent('response', [data, sw1, sw2]))
+        return data, sw1, sw2
+
+
+class MockReader:
+
+    def __init__(self, index, subscriber):
+        self.index = index
+        self.subscriber = subscriber
+
+    def createConnection(self):
+        return MockConnection(self)
+
+    def __str__(self):
+        return 'Emulated Reader ' + str(self.index)
+
+
+def readers():
+    return [MockReader(i, s) for i, s in enumerate(subscribers)]
@@ -0,0 +1,3 @@
+# Stand-in for pyscard, used by the benchmark (see usim_benchmark.py).
+# The readers hold emulated USIMs (usim_server/emulator.py), with the subscribers
+# of the json file in USIM_BENCHMARK_SUBSCRIBERS.
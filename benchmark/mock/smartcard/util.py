@@ -0,0 +1,6 @@
+def toHexString(data):
+    return ' '.join('%02X' % b for b in data)
+
+def toBytes(hexstring):
+    hexstring = hexstring.replace(' ', '')
+    return [int(hexstring[i:i + 2], 16) for i in range(0, len(hexstring), 2)]
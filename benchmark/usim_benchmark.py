@@ -0,0 +1,408 @@
+###########################################################
+#
+#             Benchmark of the USIM https servers
+#             -----------------------------------
+###########################################################
+# Starts each server version against stand-in cards, loads
+# it with imsi, rand-autn and apdu requests at fixed levels
+# of concurrency, and reports the throughput, the latency
+# (p50/p95/p99) and the APDUs sent to the card per request.
+#
+# The stand-in cards are emulated USIMs (usim_server/emulator.py):
+#   reader:   behind a mock of pyscard and card.USIM (mock/)
+#   modem:    behind a pty answering AT+CIMI and AT+CSIM
+#   emulator: in the server itself (usim_https_server_v2.py -e)
+#
+# Example:
+# python3 benchmark/usim_benchmark.py -v v1,v2,v3 -c 1,4,16 -n 500 -o results.json
+#
+# The results (json) of two runs can be compared with:
+# python3 benchmark/usim_benchmark.py -C old.json,new.json
+###########################################################
+
+import json
+import os
+import sys
+import ssl
+import time
+import tty
+import socket
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+
+from optparse import OptionParser
+from binascii import hexlify, unhexlify
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from usim_server.emulator import EmulatedCard, Subscriber, compute_opc, generate_vector, IND_BITS
+
+#version: (script, transports, request types)
+VARIANTS = {
+    'v1': ('usim_https_server.py', ('reader', 'modem'), ('imsi', 'rand-autn')),
+    'v2': ('usim_https_server_v2.py', ('reader', 'modem', 'emulator'), ('imsi', 'rand-autn', 'apdu')),
+    'v3': ('usim_https_server_v3.py', ('reader',), ('imsi', 'rand-autn')),
+}
+
+#the APDU of the apdu requests
+APDU = '00A40000023F00'
+
+#seconds to wait for a server to start
+START_TIMEOUT = 30
+
+
+#stand-in modem
+class FakeModem(threading.Thread):
+    # A pty answering AT commands for an emulated USIM. The server opens
+    # the pty slave (port) as its modem.
+
+    def __init__(self, subscriber, latency):
+        super().__init__(daemon=True)
+        self.card = EmulatedCard(subscriber, latency[0], latency[-1])
+        self.imsi = subscriber.imsi
+        self.master, slave = os.openpty()
+        tty.setraw(self.master)
+        self.slave = slave
+        self.port = os.ttyname(slave)
+
+    def run(self):
+        buffer = b''
+        while True:
+            try:
+                buffer += os.read(self.master, 4096)
+            except OSError:
+                return
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                line = line.strip().decode('ascii', 'replace')
+                if line:
+                    os.write(self.master, self.answer(line))
+
+    def answer(self, line):
+        if line == 'AT':
+            return b'\r\nOK\r\n'
+        if line == 'AT+CIMI':
+            return b'\r\n' + self.imsi.encode() + b'\r\n\r\nOK\r\n'
+        if line.startswith('AT+CSIM=') and line.count('"') == 2:
+            data, sw1, sw2 = self.card.transmit(list(unhexlify(line.split('"')[1])))
+            response = hexlify(bytes(data) + bytes([sw1, sw2])).decode().upper()
+            return ('\r\n+CSIM: %d,"%s"\r\n\r\nOK\r\n' % (len(response), response)).encode()
+        return b'\r\nERROR\r\n'
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+
+#authentication vectors
+class Vectors:
+    # Fresh rand/autn for one card. The SQN is increased by one for each
+    # vector, so IND changes and requests arriving out of order are
+    # still accepted by the card.
+
+    def __init__(self, subscriber):
+        self.k = subscriber['k']
+        self.opc = subscriber.get('opc') or hexlify(compute_opc(unhexlify(subscriber['k']), unhexlify(subscriber['op']))).decode()
+        self.amf = subscriber.get('amf', '8000')
+        self.sqn = int(subscriber.get('sqn', '000000000000'), 16) + (1 << IND_BITS)
+
+    def take(self, count):
+        vectors = []
+        for i in range(count):
+            rand, autn, res, ck, ik = generate_vector(self.k, self.opc, '%012X' % self.sqn, self.amf)
+            vectors.append('&rand=' + rand + '&autn=' + autn)
+            self.sqn += 1
+        return vectors
+
+
+#server
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def make_cert(directory):
+    path = os.path.join(directory, 'server.pem')
+    subprocess.run(['openssl', 'req', '-new', '-x509', '-keyout', path, '-out', path, '-days', '1', '-nodes', '-subj', '/CN=localhost'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return path
+
+
+class Server:
+    # One server version with one transport, and the stand-in cards behind it
+
+    def __init__(self, variant, transport, subscribers, cards, options, directory):
+        self.variant = variant
+        self.transport = transport
+        self.cards = cards
+        self.port = free_port()
+        self.modems = []
+        self.log = os.path.join(directory, variant + '-' + transport + '.log')
+        subscribers = subscribers[:cards]
+        path = os.path.join(directory, 'subscribers-' + str(cards) + '.json')
+        with open(path, 'w') as f:
+            json.dump(subscribers, f)
+
+        args = [sys.executable, os.path.join(ROOT, VARIANTS[variant][0]), '-p', str(self.port), '-c', options.cert, '-q', str(options.queue_size)]
+        if transport == 'reader':
+            args += ['-r', ','.join(str(i) for i in range(cards))]
+        elif transport == 'modem':
+            for subscriber in subscribers:
+                modem = FakeModem(Subscriber(**subscriber), options.latency)
+                modem.start()
+                self.modems.append(modem)
+            args += ['-m', ','.join(modem.port for modem in self.modems)]
+        else:
+            args += ['-e', path, '-l', ','.join(str(x) for x in options.latency)]
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.join(HERE, 'mock'), ROOT])
+        env['USIM_BENCHMARK_SUBSCRIBERS'] = path
+        env['USIM_BENCHMARK_LATENCY'] = ','.join(str(x) for x in options.latency)
+        self.log_file = open(self.log, 'w')
+        self.process = subprocess.Popen(args, env=env, cwd=directory, stdout=self.log_file, stderr=subprocess.STDOUT)
+        self.vectors = [Vectors(subscriber) for subscriber in subscribers]
+
+    def wait(self):
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('Server exited, see ' + self.log)
+            try:
+                if self.ready():
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError('Server not started after ' + str(START_TIMEOUT) + ' seconds, see ' + self.log)
+
+    def connection(self):
+        return http.client.HTTPSConnection('127.0.0.1', self.port, timeout=60, context=ssl._create_unverified_context())
+
+    def ready(self):
+        # the cards are warm (/readyz)
+        connection = self.connection()
+        try:
+            connection.request('GET', '/readyz')
+            response = connection.getresponse()
+            response.read()
+            return response.status == 200
+        finally:
+            connection.close()
+
+    def metrics(self):
+        # number of APDUs sent to the cards so far
+        connection = self.connection()
+        try:
+            connection.request('GET', '/metrics')
+            body = connection.getresponse().read().decode('utf-8')
+        finally:
+            connection.close()
+        apdus = 0
+        for line in body.splitlines():
+            if line.startswith('usim_apdu_seconds_count'):
+                apdus += int(float(line.split()[-1]))
+        return apdus
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log_file.close()
+        for modem in self.modems:
+            modem.close()
+
+
+#load
+def paths(server, request_type, count):
+    # the requests to send, spread over the cards
+    if request_type == 'imsi':
+        queries = ['?type=imsi'] * count
+    elif request_type == 'apdu':
+        queries = ['?type=apdu&hex=' + APDU] * count
+    else:
+        per_card = [vectors.take(count // server.cards + 1) for vectors in server.vectors]
+        queries = ['?type=rand-autn' + per_card[i % server.cards][i // server.cards] for i in range(count)]
+    if server.variant == 'v2':
+        queries = [query + '&card=' + str(i % server.cards) for i, query in enumerate(queries)]
+    return ['/' + query for query in queries]
+
+def run(server, request_type, concurrency, count, keepalive):
+    # returns the latencies (seconds), status codes and bodies of count requests
+    requests = paths(server, request_type, count)
+    results = [None] * count
+    position = [0]
+    lock = threading.Lock()
+
+    def client():
+        connection = None
+        while True:
+            with lock:
+                i = position[0]
+                position[0] += 1
+            if i >= count:
+                break
+            start = time.perf_counter()
+            try:
+                if connection is None:
+                    connection = server.connection()
+                connection.request('GET', requests[i])
+                response = connection.getresponse()
+                body = response.read()
+                results[i] = (time.perf_counter() - start, response.status, body)
+                if not keepalive or response.will_close:
+                    connection.close()
+                    connection = None
+            except (OSError, http.client.HTTPException) as e:
+                results[i] = (time.perf_counter() - start, 0, str(e).encode())
+                if connection is not None:
+                    connection.close()
+                connection = None
+        if connection is not None:
+            connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, results
+
+def percentile(values, p):
+    # nearest rank, values sorted
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+def summary(server, request_type, concurrency, duration, results, apdus):
+    latencies = sorted(r[0] for r in results)
+    ok = [r for r in results if r[1] == 200]
+    sync_failures = 0
+    if request_type == 'rand-autn':
+        sync_failures = sum(1 for r in ok if json.loads(r[2]).get('ck') is None)
+    ms = lambda x: None if x is None else round(x * 1000, 3)
+    return {
+        'variant': server.variant,
+        'transport': server.transport,
+        'cards': server.cards,
+        'type': request_type,
+        'concurrency': concurrency,
+        'requests': len(results),
+        'ok': len(ok),
+        'busy': sum(1 for r in results if r[1] == 503),
+        'errors': sum(1 for r in results if r[1] not in (200, 503)),
+        'sync_failures': sync_failures,
+        'seconds': round(duration, 3),
+        'throughput': round(len(results) / duration, 1),
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+        'apdus_per_request': round(apdus / len(results), 2),
+    }
+
+
+#report
+COLUMNS = ('variant', 'transport', 'type', 'concurrency', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'apdus_per_request', 'ok', 'busy', 'errors')
+
+def print_row(values):
+    print(' '.join(str(v).rjust(max(len(c), 9)) for c, v in zip(COLUMNS, values)), flush=True)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = {tuple(r[c] for c in COLUMNS[:4]): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    print_row(COLUMNS[:4] + ('throughput', 'p50_ms', 'p99_ms', 'old_tput', 'old_p50', 'old_p99'))
+    for r in new:
+        o = old.get(tuple(r[c] for c in COLUMNS[:4]), {})
+        print_row([r[c] for c in COLUMNS[:4]] + [r['throughput'], r['p50_ms'], r['p99_ms'], o.get('throughput'), o.get('p50_ms'), o.get('p99_ms')])
+
+
+
+####### Main #######
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-v", "--variants", dest="variants", default="v1,v2,v3", help="server versions (Default: v1,v2,v3)")
+    parser.add_option("-T", "--transports", dest="transports", default="reader,modem,emulator", help="transports, the ones a version doesn't have are skipped (Default: reader,modem,emulator)")
+    parser.add_option("-t", "--types", dest="types", default="imsi,rand-autn,apdu", help="request types, the ones a version doesn't have are skipped (Default: imsi,rand-autn,apdu)")
+    parser.add_option("-c", "--concurrency", dest="concurrency", default="1,4,16", help="levels of concurrency (Default: 1,4,16)")
+    parser.add_option("-n", "--requests", dest="requests", type="int", default=200, help="requests for each type and level of concurrency (Default: 200)")
+    parser.add_option("-w", "--warmup", dest="warmup", type="int", default=10, help="requests sent before each measure (Default: 10)")
+    parser.add_option("-k", "--cards", dest="cards", type="int", default=1, help="cards behind version 2 (Default: 1)")
+    parser.add_option("-l", "--latency", dest="latency", default="0", help="seconds added to every APDU of the stand-in cards, or to every APDU and to AUTHENTICATE (i.e. 0.005,0.1) (Default: 0)")
+    parser.add_option("-q", "--queue-size", dest="queue_size", type="int", default=1024, help="queue size given to the servers (Default: 1024)")
+    parser.add_option("-N", "--new-connections", dest="keepalive", action="store_false", default=True, help="a new connection (and TLS handshake) for every request")
+    parser.add_option("-s", "--subscribers", dest="subscribers", default=os.path.join(HERE, 'subscribers.json'), help="subscribers of the stand-in cards (Default: benchmark/subscribers.json)")
+    parser.add_option("--cert", dest="cert", help="server.pem file (Default: a new self signed certificate)")
+    parser.add_option("-o", "--output", dest="output", default="benchmark_results.json", help="json file for the results (Default: benchmark_results.json)")
+    parser.add_option("-C", "--compare", dest="compare", help="compare two result files (old.json,new.json)")
+    (options, args) = parser.parse_args()
+
+    if options.compare is not None:
+        compare(*options.compare.split(','))
+        exit()
+
+    options.latency = [float(x) for x in options.latency.split(',')]
+    with open(options.subscribers) as f:
+        subscribers = json.load(f)
+    directory = tempfile.mkdtemp(prefix='usim-benchmark-')
+    if options.cert is None:
+        options.cert = make_cert(directory)
+
+    results = []
+    print_row(COLUMNS)
+    for variant in options.variants.split(','):
+        script, transports, types = VARIANTS[variant]
+        for transport in options.transports.split(','):
+            if transport not in transports:
+                continue
+            cards = min(options.cards, len(subscribers)) if variant == 'v2' else 1
+            server = Server(variant, transport, subscribers, cards, options, directory)
+            try:
+                server.wait()
+                for request_type in options.types.split(','):
+                    if request_type not in types:
+                        continue
+                    for concurrency in [int(c) for c in options.concurrency.split(',')]:
+                        if options.warmup:
+                            run(server, request_type, concurrency, options.warmup, options.keepalive)
+                        apdus = server.metrics()
+                        duration, responses = run(server, request_type, concurrency, options.requests, options.keepalive)
+                        result = summary(server, request_type, concurrency, duration, responses, server.metrics() - apdus)
+                        results.append(result)
+                        print_row([result[c] for c in COLUMNS])
+            except RuntimeError as e:
+                print(variant + ' ' + transport + ': ' + str(e))
+            finally:
+                server.stop()
+
+    report = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': options.latency,
+        'requests': options.requests,
+        'keepalive': options.keepalive,
+        'results': results,
+    }
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent = "\t")
+    print('Results saved in ' + options.output + ', server logs in ' + directory)
@@ -0,0 +1,17 @@
+###########################################################
+#
+#                 Software USIM emulator
+#                 ----------------------
+###########################################################
+# Prints an authentication vector for an emulated USIM (see
+# usim_server/emulator.py):
+#
+# python3 usim_emulator.py -k <K> -o <OPc> -s <SQN>
+###########################################################
+
+from usim_server.emulator import main
+
+
+####### Main #######
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+###########################################################
+#
+#              USIM server core (usim_server)
+#              ------------------------------
+###########################################################
+# The parts shared by the usim_https_server*.py scripts, to be
+# imported and used in another process, i.e. without the https
+# hop when the client runs on the same machine:
+#
+# from usim_server import Connector, APDUCard, CardWorker, CardPool, StaticCache, open_reader
+#
+# card = APDUCard(Connector('reader 0', 'pyscard', lambda: open_reader(0)))
+# pool = CardPool([CardWorker(0, card)], StaticCache())
+# pool.start()
+# worker = pool.select()
+# res, ck, ik = worker.call(worker.card.res_ck_ik, rand, autn)
+#
+# Every card is served by its worker thread, that owns its connection.
+# From asyncio, without a thread per request:
+#
+# res, ck, ik = await worker.acall(worker.card.res_ck_ik, rand, autn)
+#
+# Transports (open_*): modem (AT+CSIM), pyscard reader, card.USIM
+# (with USIMCard) and the emulator (usim_server.emulator).
+#
+# The https server is Server(pool, port, cert).serve_forever(),
+# and the command line is python3 -m usim_server -h
+###########################################################
+
+from .card import APDUCard, USIMCard
+from .metrics import metrics
+from .pool import CardBusy, CardWorker, CardPool, StaticCache, AKACache, CardEventObserver, ReaderEventObserver, PortMonitor
+from .server import Server
+from .tracing import tracer
+from .transport import Connector, CardUnavailable, ModemTransport, ModemError, TrackedConnection, open_modem, open_reader, open_usim, open_emulator
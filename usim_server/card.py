@@ -0,0 +1,552 @@
+#card operations
+#
+# APDUCard runs the operations with APDUs (modem, pyscard reader or
+# emulator), USIMCard with card.USIM, that also handles cards the APDUs
+# here don't (i.e. blank USIMs). Both go through a Connector.
+
+from .codec import decode_bcd, int2hex, to_hex, to_bytes, parse_aka
+from .transport import LogicalChannel, ModemError, TrackedConnection
+from .tracing import tracer
+
+SELECT_MF = '00A40000023F00'
+SELECT_DF_GSM = '00A40000027F20'
+SELECT_EF_IMSI = '00A40000026F07'
+SELECT_EF_DIR = '00A40000022F00'
+SELECT_ADF_USIM = '00A4040010A0000000871002FFFFFFFF8903050001'
+
+SELECT_EF_ICCID = '00A40000022FE2'
+SELECT_EF_AD = '00A40000026FAD'
+SELECT_DF_TELECOM = '00A40000027F10'
+SELECT_EF_MSISDN = '00A40000026F40'
+
+PATH_EF_IMSI = (SELECT_MF, SELECT_DF_GSM, SELECT_EF_IMSI)
+PATH_ADF_USIM = (SELECT_MF, SELECT_EF_DIR, SELECT_ADF_USIM)
+PATH_EF_ICCID = (SELECT_MF, SELECT_EF_ICCID)
+PATH_EF_AD = (SELECT_MF, SELECT_DF_GSM, SELECT_EF_AD)
+PATH_EF_MSISDN = (SELECT_MF, SELECT_DF_TELECOM, SELECT_EF_MSISDN)
+
+READ_EF_IMSI = to_bytes('00B0000009')
+READ_EF_ICCID = to_bytes('00B000000A')
+READ_EF_AD = to_bytes('00B0000000')
+READ_EF_MSISDN = to_bytes('00B2010400')
+
+#AUTHENTICATE (3G context) header, followed by RAND, 0x10 and AUTN
+AUTHENTICATE = to_bytes('0088008122' + '10')
+
+#MANAGE CHANNEL open (the card gives the channel number) and close (+ channel as P2)
+OPEN_CHANNEL = to_bytes('0070000001')
+CLOSE_CHANNEL = to_bytes('007080')
+
+#largest Le of a short APDU, and of an extended one (ISO/IEC 7816-4 5.1)
+SHORT_LE = 256
+EXTENDED_LE = 65536
+
+#highest offset of READ BINARY (15 bits of P1-P2)
+MAX_OFFSET = 0x7FFF
+
+#protocol T=1 of a pyscard connection (CardConnection.T1_protocol)
+T1_PROTOCOL = 2
+
+#structure of an EF (FCP file descriptor byte, ETSI TS 102 221 11.1.1.4.3)
+STRUCTURES = {1: 'transparent', 2: 'linear-fixed', 6: 'cyclic'}
+
+#status words a script goes on with, unless the APDU gives its own (X is any digit)
+SW_OK = ('9000', '91XX', '92XX')
+
+#instructions that write to the card (and may change its static data)
+WRITE_INS = (0xD6, 0xDC, 0xE2, 0xE0, 0xE4, 0x44, 0x04)
+
+
+#instructions that only read (READ BINARY, READ RECORD, STATUS, GET DATA):
+#the same APDU sent twice in a row gets the same response
+READ_INS = (0xB0, 0xB2, 0xF2, 0xCA)
+
+
+def writes(hexstring):
+    return int(hexstring[2:4], 16) in WRITE_INS
+
+def reads(hexstring):
+    return int(hexstring[2:4], 16) in READ_INS
+
+
+#modem functions
+def get_imsi(ser):
+
+    imsi = None
+
+    for m in ser.command('AT+CIMI'):
+        if len(m) == 15:
+            imsi = m
+
+    return imsi
+
+
+#reader functions
+def read_imsi(connection):
+    imsi = None
+
+    data, sw1, sw2 = connection.select_and_transmit(PATH_EF_IMSI, READ_EF_IMSI)
+    imsi = decode_bcd(data)[-15:]
+
+    return imsi
+
+def read_file(connection, path, apdu):
+    # READ BINARY or READ RECORD with Le=0, resent with the right Le on 6Cxx
+    data, sw1, sw2 = connection.select_and_transmit(path, apdu)
+    if sw1 in (0x6C, 0x61):
+        data, sw1, sw2 = chain(connection, apdu, data, sw1, sw2)
+    if sw1 != 0x90:
+        return None
+    return data
+
+def read_iccid(connection):
+    data = read_file(connection, PATH_EF_ICCID, READ_EF_ICCID)
+    if data is None:
+        return None
+    return decode_bcd(data).rstrip('F')
+
+def read_ad(connection):
+    data = read_file(connection, PATH_EF_AD, READ_EF_AD)
+    if data is None:
+        return None
+    return to_hex(data)
+
+def read_msisdn(connection):
+    data = read_file(connection, PATH_EF_MSISDN, READ_EF_MSISDN)
+    if data is None or len(data) < 14:
+        return None
+    # alpha identifier, then length of the BCD number, TON/NPI and the number
+    x = len(data) - 14
+    length = data[x]
+    if length < 2 or length > 11:
+        return None
+    return decode_bcd(data[x + 2:x + 1 + length]).rstrip('F')
+
+def aka_connection(connection):
+    # AKA runs on its own logical channel, opened on first use, so the USIM
+    # stays selected whatever raw APDUs do on the basic channel. A card (or
+    # modem) without a free channel authenticates on the basic channel.
+    if not hasattr(connection, 'aka'):
+        return connection
+    if connection.aka is None:
+        channel = open_channel(connection)
+        if channel is None:
+            connection.aka = connection
+        else:
+            connection.aka = TrackedConnection(LogicalChannel(connection.connection, channel))
+    return connection.aka
+
+def read_aka(connection, rand, autn, logical=True):
+    # on the AKA channel, or on the basic channel without logical
+    apdu = AUTHENTICATE + to_bytes(rand) + [0x10] + to_bytes(autn)
+    channel = aka_connection(connection) if logical else connection
+    data, sw1, sw2 = channel.select_and_transmit(PATH_ADF_USIM, apdu)
+    if sw1 == 0x68 and channel is not connection:
+        # the channel was closed (i.e. by a raw MANAGE CHANNEL), it is
+        # opened again on the next authentication
+        connection.aka = None
+        channel = connection
+        data, sw1, sw2 = channel.select_and_transmit(PATH_ADF_USIM, apdu)
+    data, sw1, sw2 = chain(channel, apdu, data, sw1, sw2)
+    result = None
+    if sw1 == 0x90:
+        result = parse_aka(data)
+    if result is None:
+        return {'status': 'error', 'sw1': int2hex(sw1), 'sw2': int2hex(sw2)}
+    return result
+
+def read_apdu(connection, hexstring):
+
+    data = None
+    sw1 = None
+    sw2 = None
+
+    # the APDU may change the selection in the card
+    connection.invalidate()
+    data, sw1, sw2 = connection.transmit(to_bytes(hexstring))
+    data = to_hex(data)
+    return data, int2hex(sw1), int2hex(sw2)
+
+def read_batch(connection, items, logical=True):
+    # The items run one after the other in the same job, so the USIM stays
+    # selected between authentications.
+    results = []
+    for item in items:
+        try:
+            if 'apdu' in item:
+                data, sw1, sw2 = read_apdu(connection, item['apdu'])
+                results.append({'status': 'ok', 'data': data, 'sw1': sw1, 'sw2': sw2})
+            elif 'rand' in item and 'autn' in item:
+                results.append(read_aka(connection, item['rand'], item['autn'], logical))
+            else:
+                results.append({'status': 'error', 'error_msg': 'Expected rand and autn, or apdu'})
+        except Exception as e:
+            results.append({'status': 'error', 'error_msg': str(e)})
+    return results
+
+def get_responses(connection, cla, data, sw1, sw2):
+    # GET RESPONSE while the card has more data (61xx), on the channel of
+    # the command, and with the right Le if the card asks for it (6Cxx)
+    with tracer.span('get-response') as span:
+        data = list(data)
+        while sw1 == 0x61:
+            command = [get_response_cla(cla), 0xC0, 0x00, 0x00, sw2]
+            more, sw1, sw2 = connection.transmit(command)
+            if sw1 == 0x6C:
+                more, sw1, sw2 = connection.transmit(command[:4] + [sw2])
+            data += more
+        if span is not None:
+            span.attributes['response_length'] = len(data)
+    return data, sw1, sw2
+
+def chain(connection, apdu, data, sw1, sw2, get_response=True, fix_le=True):
+    # the rest of transceive(), after apdu was sent and answered
+    if fix_le and sw1 == 0x6C and len(apdu) == 5:
+        data, sw1, sw2 = connection.transmit(list(apdu[:4]) + [sw2])
+    if get_response and sw1 == 0x61:
+        data, sw1, sw2 = get_responses(connection, apdu[0], data, sw1, sw2)
+    return data, sw1, sw2
+
+def transceive(connection, apdu, get_response=True, fix_le=True):
+    # Sends apdu and returns the whole response: a short Le the card
+    # corrects (6Cxx) is fixed, and 61xx is followed by GET RESPONSE
+    # until all the data is read.
+    data, sw1, sw2 = connection.transmit(apdu)
+    return chain(connection, apdu, data, sw1, sw2, get_response, fix_le)
+
+def extended_length(atr):
+    # True when the card capabilities (historical bytes of the ATR, ISO/IEC
+    # 7816-4 8.1.1.2.7) say it takes extended Lc and Le fields
+    atr = bytes(atr)
+    if len(atr) < 2:
+        return False
+    i, y, k = 1, atr[1] >> 4, atr[1] & 0x0F
+    while True:
+        i += bin(y).count('1')
+        if not y & 0x08 or i >= len(atr):
+            break
+        y = atr[i] >> 4
+    historical = atr[i + 1:i + 1 + k]
+    if not historical or historical[0] != 0x80:
+        return False
+    j = 1
+    while j < len(historical):
+        tag, length = historical[j] >> 4, historical[j] & 0x0F
+        value = historical[j + 1:j + 1 + length]
+        if tag == 0x7 and len(value) >= 3:
+            return bool(value[2] & 0x40)
+        j += 1 + length
+    return False
+
+def max_le(connection):
+    # Le of the largest READ the card takes: extended APDUs need a card
+    # that says so in its ATR, and T=1 (not through AT+CSIM)
+    try:
+        if connection.getProtocol() == T1_PROTOCOL and extended_length(connection.getATR()):
+            return EXTENDED_LE
+    except Exception:
+        pass
+    return SHORT_LE
+
+def select_fid(fid):
+    # SELECT by file id, asking for the FCP (P2 04)
+    return '00A4000402' + fid
+
+def path_of(hexstring):
+    # SELECTs of a file path (file ids from the MF, i.e. 3F007F106F3A);
+    # 7FFF is the USIM application (ETSI TS 102 221 8.4.2)
+    fids = [hexstring[i:i + 4].upper() for i in range(0, len(hexstring), 4)]
+    if len(hexstring) % 4 or not fids:
+        raise ValueError('Expected a path of file ids')
+    if fids[0] == '3F00':
+        fids = fids[1:]
+    path = [SELECT_MF]
+    for fid in fids:
+        if fid == '7FFF':
+            path = list(PATH_ADF_USIM)
+        else:
+            path.append(select_fid(fid))
+    return tuple(path)
+
+def parse_fcp(data):
+    # structure, size (transparent EFs) or record length and count
+    # (record EFs) from the FCP template (62) of a SELECT
+    data = bytes(data)
+    if len(data) < 2 or data[0] != 0x62:
+        return None
+    fcp = {}
+    i = 2
+    while i + 1 < len(data):
+        tag, length = data[i], data[i + 1]
+        value = data[i + 2:i + 2 + length]
+        if tag == 0x82 and value:
+            fcp['structure'] = STRUCTURES.get(value[0] & 0x07, 'df' if value[0] & 0x38 == 0x38 else 'other')
+            if len(value) >= 5:
+                fcp['record_length'] = int.from_bytes(value[2:4], 'big')
+                fcp['records'] = value[4]
+        elif tag == 0x80:
+            fcp['size'] = int.from_bytes(value, 'big')
+        i += 2 + length
+    return fcp
+
+def read_ef(connection, hexstring):
+    return read_path(connection, path_of(hexstring), hexstring)
+
+def read_path(connection, path, name):
+    # The whole content of an EF (path of SELECTs), in the fewest commands:
+    # a transparent EF in READ BINARYs of the largest Le the card takes, a
+    # record EF in one READ RECORD per record (with its length, so none is
+    # resent on 6Cxx). Without structure when the file (or its DF) isn't
+    # found, with the status of the SELECT that failed.
+    # After an EF, its DF is kept as the selection: the EFs next to it
+    # only need their own SELECT. A file not found (6A8X) doesn't change
+    # the selection either, so a dump probes each file id in one SELECT.
+    parent = path[:-1]
+    connection.select(parent)
+    if connection.selected != parent:
+        sw1, sw2 = connection.status
+        return {'path': name, 'sw1': int2hex(sw1), 'sw2': int2hex(sw2)}
+    data, sw1, sw2 = transceive(connection, to_bytes(path[-1]))
+    if sw1 != 0x90:
+        connection.selected = parent if sw1 == 0x6A else ()
+        return {'path': name, 'sw1': int2hex(sw1), 'sw2': int2hex(sw2)}
+    fcp = parse_fcp(data) or {}
+    result = {'path': name, 'structure': fcp.get('structure', 'other')}
+    connection.selected = path if result['structure'] == 'df' else parent
+    if result['structure'] == 'transparent':
+        content, sw1, sw2 = read_binary(connection, fcp.get('size', 0))
+        result['size'] = len(content)
+        result['data'] = to_hex(content)
+    elif result['structure'] in ('linear-fixed', 'cyclic'):
+        records = []
+        for record in range(1, fcp.get('records', 0) + 1):
+            data, sw1, sw2 = transceive(connection, [0x00, 0xB2, record, 0x04, fcp['record_length'] & 0xFF])
+            if sw1 != 0x90:
+                break
+            records.append(to_hex(data))
+        result['record_length'] = fcp.get('record_length')
+        result['records'] = records
+    result['sw1'] = int2hex(sw1)
+    result['sw2'] = int2hex(sw2)
+    return result
+
+def read_aids(connection):
+    # AIDs of the applications listed in EF_DIR
+    aids = []
+    for record in read_path(connection, (SELECT_MF, SELECT_EF_DIR), '3F002F00').get('records', []):
+        data = bytes.fromhex(record)
+        if len(data) > 4 and data[0] == 0x61 and data[2] == 0x4F:
+            aids.append(data[4:4 + data[3]].hex().upper())
+    return aids
+
+def read_binary(connection, size):
+    # size bytes of the selected transparent EF (up to the highest offset)
+    limit = max_le(connection)
+    content = []
+    sw1, sw2 = 0x90, 0x00
+    while len(content) < size and len(content) <= MAX_OFFSET:
+        le = min(size - len(content), limit)
+        offset = len(content)
+        apdu = [0x00, 0xB0, offset >> 8, offset & 0xFF]
+        if le > SHORT_LE:
+            apdu += [0x00, (le >> 8) & 0xFF, le & 0xFF]
+        else:
+            apdu += [le & 0xFF]
+        data, sw1, sw2 = transceive(connection, apdu)
+        if sw1 != 0x90 or not data:
+            break
+        content += data
+    return content, sw1, sw2
+
+def sw_matches(sw, patterns):
+    for pattern in patterns:
+        if all(p in 'Xx' or p.upper() == s for p, s in zip(pattern, sw)):
+            return True
+    return False
+
+def get_response_cla(cla):
+    # GET RESPONSE keeps the logical channel of the command
+    if cla & 0x40:
+        return 0x40 | (cla & 0x0F)
+    return cla & 0x03
+
+def open_channel(connection):
+    # number of the new logical channel, None when the card (or the modem,
+    # with an AT error) has no free one
+    try:
+        data, sw1, sw2 = connection.transmit(OPEN_CHANNEL)
+    except ModemError:
+        return None
+    if sw1 != 0x90 or len(data) != 1:
+        return None
+    return data[0]
+
+def close_channel(connection, channel):
+    data, sw1, sw2 = connection.transmit(CLOSE_CHANNEL + [channel])
+    return sw1 == 0x90
+
+def close_channels(connection, channels):
+    # Before the connection is reset: closes the logical channels of the
+    # sessions, and the AKA one. A card that was really reset has none
+    # open any more, the errors are ignored.
+    aka = getattr(connection, 'aka', None)
+    if aka is not None and aka is not connection:
+        channels = list(channels) + [aka.connection.channel]
+    for channel in channels:
+        close_channel(connection, channel)
+
+def read_channel_apdu(connection, channel, hexstring):
+    # The APDU is sent on the logical channel whatever its CLA, so the
+    # selection of the basic channel (used by the other requests) is kept.
+    data, sw1, sw2 = LogicalChannel(connection, channel).transmit(to_bytes(hexstring))
+    return to_hex(data), int2hex(sw1), int2hex(sw2)
+
+def read_script(connection, apdus, get_response=True, fix_le=True, stop_on_error=True):
+    # the APDUs may change the selection in the card
+    connection.invalidate()
+    responses = []
+    stopped = False
+    for item in apdus:
+        if not isinstance(item, dict):
+            item = {'hex': item}
+        apdu = to_bytes(item['hex'])
+        data, sw1, sw2 = transceive(connection, apdu, get_response, fix_le)
+        sw = (int2hex(sw1) + int2hex(sw2)).upper()
+        responses.append({'apdu': item['hex'], 'data': to_hex(data), 'sw1': int2hex(sw1), 'sw2': int2hex(sw2)})
+        expected = item.get('expect', SW_OK if get_response else SW_OK + ('61XX',))
+        if stop_on_error and not sw_matches(sw, expected):
+            stopped = True
+            break
+    return responses, stopped
+
+
+def res_ck_ik(result):
+    # read_aka() result as res, ck, ik
+    if 'auts' in result: #AUTS goes in RES position, like in version 3
+        return result['auts'], None, None
+    return result.get('res'), result.get('ck'), result.get('ik')
+
+
+class APDUCard:
+    # Card operations with APDUs. The imsi of a modem comes from AT+CIMI.
+
+    operations = ('imsi', 'card-info', 'rand-autn', 'apdu', 'batch', 'script', 'open-session', 'close-session', 'file', 'dump')
+
+    def __init__(self, connector):
+        self.connector = connector
+
+    def imsi(self):
+        if self.connector.transport == 'modem':
+            return self.connector.call(get_imsi)
+        return self.connector.call(read_imsi)
+
+    def static(self):
+        # returns the identity of the card (ATR and ICCID) and its static data
+        return self.connector.call(self.read_static)
+
+    def warm(self):
+        # static(), with the USIM also selected for the first authentication
+        return self.connector.call(self.read_warm)
+
+    def read_warm(self, connection):
+        static = self.read_static(connection)
+        if self.connector.persistent:
+            (aka_connection(connection) if self.logical() else connection).select(PATH_ADF_USIM)
+        return static
+
+    def logical(self):
+        # AKA only gets its own logical channel with a kept connection (it
+        # would be opened again for every request), and not on modems: many
+        # refuse MANAGE CHANNEL, or logical channel CLAs, through AT+CSIM
+        return self.connector.persistent and self.connector.transport != 'modem'
+
+    def read_static(self, connection):
+        atr = ''
+        if self.connector.transport != 'modem':
+            atr = to_hex(connection.getATR())
+        files = {}
+        files['imsi'] = get_imsi(connection) if self.connector.transport == 'modem' else read_imsi(connection)
+        files['iccid'] = read_iccid(connection)
+        files['ad'] = read_ad(connection)
+        files['msisdn'] = read_msisdn(connection)
+        return (atr, files['iccid']), files
+
+    def aka(self, rand, autn):
+        return self.connector.call(read_aka, rand, autn, self.logical())
+
+    def res_ck_ik(self, rand, autn):
+        return res_ck_ik(self.aka(rand, autn))
+
+    def apdu(self, hexstring):
+        return self.connector.call(read_apdu, hexstring)
+
+    def batch(self, items):
+        return self.connector.call(read_batch, items, self.logical())
+
+    def open_channel(self):
+        return self.connector.call(open_channel)
+
+    def close_channel(self, channel):
+        return self.connector.call(close_channel, channel)
+
+    def release(self, channels):
+        return self.connector.call(close_channels, channels)
+
+    def channel_apdu(self, channel, hexstring):
+        return self.connector.call(read_channel_apdu, channel, hexstring)
+
+    def file(self, path):
+        return self.connector.call(read_ef, path)
+
+    def entry(self, path, name):
+        return self.connector.call(read_path, path, name)
+
+    def applications(self):
+        return self.connector.call(read_aids)
+
+    def script(self, apdus, get_response=True, fix_le=True, stop_on_error=True):
+        return self.connector.call(read_script, apdus, get_response, fix_le, stop_on_error)
+
+
+class USIMCard:
+    # Card operations with card.USIM (https://github.com/mitshell/card)
+
+    operations = ('imsi', 'card-info', 'rand-autn')
+
+    def __init__(self, connector):
+        self.connector = connector
+
+    def imsi(self):
+        return self.connector.call(lambda connection: connection.usim.get_imsi())
+
+    def static(self):
+        return self.connector.call(self.read_static)
+
+    def warm(self):
+        # card.USIM selects the USIM itself when authenticating
+        return self.static()
+
+    def release(self, channels):
+        # no logical channels with card.USIM
+        pass
+
+    def read_static(self, connection):
+        atr = to_hex(connection.getATR())
+        imsi = connection.usim.get_imsi()
+        return (atr, imsi), {'imsi': imsi}
+
+    def aka(self, rand, autn):
+        return self.connector.call(self.read_aka, rand, autn)
+
+    def read_aka(self, connection, rand, autn):
+        x = connection.usim.authenticate(RAND=to_bytes(rand), AUTN=to_bytes(autn))
+        if x is None:
+            return {'status': 'error'}
+        if len(x) == 1:
+            return {'status': 'sync-failure', 'auts': to_hex(x[0])}
+        if len(x) > 2:
+            return {'status': 'ok', 'res': to_hex(x[0]), 'ck': to_hex(x[1]), 'ik': to_hex(x[2])}
+        return {'status': 'error'}
+
+    def res_ck_ik(self, rand, autn):
+        return res_ck_ik(self.aka(rand, autn))
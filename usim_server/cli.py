@@ -0,0 +1,164 @@
+#command line
+#
+# python3 -m usim_server [options], or one of the usim_https_server*.py
+# scripts, that keep the options and API of each version.
+
+import os
+import socket
+
+from functools import partial
+from optparse import OptionParser
+
+from .card import APDUCard, USIMCard
+from .metrics import metrics
+from .pool import CardWorker, CardPool, StaticCache, AKACache, CardEventObserver, ReaderEventObserver, PortMonitor
+from .server import Server, PATH, REQUEST_TYPES
+from .tracing import tracer, FORMATS
+from .transport import Connector, open_modem, open_reader, open_usim, open_emulator, find_reader, find_port, smartcard_errors
+
+#request types of version 1 and 3
+BASIC_TYPES = ('imsi', 'rand-autn')
+
+
+def parse_args(argv=None):
+    parser = OptionParser()
+    parser.add_option("-m", "--modem", dest="modem", action="append", help="modem port (i.e. COMX, or /dev/ttyUSBX). Can be repeated or comma separated")
+    parser.add_option("-r", "--reader", dest="reader", action="append", help="reader index (i.e. 0, 1, 2, ...). Can be repeated or comma separated")
+    parser.add_option("-u", "--usim", dest="usim", action="append", help="reader index, used through card.USIM (i.e. 0, 1, 2, ...). Can be repeated or comma separated")
+    parser.add_option("-e", "--emulator", dest="emulator", help="json file with the subscribers of emulated USIMs (see usim_server/emulator.py)")
+    parser.add_option("-l", "--latency", dest="latency", default="0", help="seconds added to every emulated APDU, or to every APDU and to AUTHENTICATE (i.e. 0.005,0.1) (Default: 0)")
+    parser.add_option("-o", "--on-demand", dest="on_demand", action="store_true", default=False, help="connect to the card for every request, instead of keeping the connection")
+    parser.add_option("-t", "--cache-ttl", dest="cache_ttl", type="float", default=0, help="seconds the static card data (imsi, iccid, ...) is cached (Default: 0, until the card is removed)")
+    parser.add_option("-a", "--aka-cache", dest="aka_cache", type="float", default=30, help="seconds the result of a rand-autn is kept, to answer a retry of the same rand and autn without the card (Default: 30, 0 to disable)")
+    parser.add_option("--aka-cache-size", dest="aka_cache_size", type="int", default=1024, help="maximum number of rand-autn results kept (Default: 1024)")
+    parser.add_option("-q", "--queue-size", dest="queue_size", type="int", default=16, help="maximum number of requests waiting for each card (Default: 16)")
+    parser.add_option("-i", "--idle-timeout", dest="idle_timeout", type="float", default=30, help="seconds before an idle connection is closed (Default: 30)")
+    parser.add_option("-p", "--port", dest="port", type="int", default=443, help="https port (Default: 443)")
+    parser.add_option("-c", "--cert", dest="cert", default=PATH, help="server.pem file (Default: " + PATH + ")")
+    parser.add_option("-P", "--processes", dest="processes", type="int", default=1, help="server processes, each one with its share of the cards (Default: 1)")
+    parser.add_option("--trace", dest="trace", help="file where the spans of every request are written (see usim_server/tracing.py)")
+    parser.add_option("--trace-format", dest="trace_format", type="choice", choices=FORMATS, default="jsonl", help="format of the trace file: jsonl, or otlp for the OpenTelemetry collector (Default: jsonl)")
+    (options, args) = parser.parse_args(argv)
+    return options
+
+def split_option(values):
+    return [v.strip() for value in values or [] for v in value.split(',') if v.strip()]
+
+def card_specs(options):
+    # (transport, modem port, reader index or subscriber) of every card,
+    # the index of a card is its place in this list
+    specs = [('modem', port) for port in split_option(options.modem)]
+    specs += [('pyscard', index) for index in split_option(options.reader)]
+    specs += [('card.USIM', index) for index in split_option(options.usim)]
+    if options.emulator is not None:
+        from .emulator import load_subscribers
+        specs += [('emulator', subscriber) for subscriber in load_subscribers(options.emulator)]
+    return specs
+
+def build_card(options, index, transport, value):
+    # Modems, readers and cards missing at startup are waited for (see the
+    # monitors in serve()). The cards are opened by the workers when the
+    # pool starts (warm-up).
+    persistent = not options.on_demand
+    if transport == 'modem':
+        return APDUCard(Connector(value, 'modem', partial(open_modem, value), persistent, locate=partial(find_port, value), index=index))
+    if transport == 'emulator':
+        latency = [float(x) for x in options.latency.split(',')]
+        return APDUCard(Connector('Emulator ' + value.imsi, 'emulator', partial(open_emulator, value, latency[0], latency[-1]), persistent, index=index))
+    open, card = (open_reader, APDUCard) if transport == 'pyscard' else (open_usim, USIMCard)
+    name = find_reader(value)
+    connector = Connector(name or 'Reader ' + value, transport, partial(open, value), persistent, smartcard_errors(), partial(find_reader, value), index)
+    if name is None:
+        print('Unable to connect to reader ' + value + ', waiting for it.')
+        connector.present = False
+    return card(connector)
+
+def build_pool(options, shard=0, shards=1):
+    # One worker per modem, reader and emulated subscriber. With shards, only
+    # the cards of this shard (index modulo shards), see shard.py.
+    workers = []
+    for index, (transport, value) in enumerate(card_specs(options)):
+        if index % shards == shard:
+            workers.append(CardWorker(index, build_card(options, index, transport, value), options.queue_size))
+    return CardPool(workers, StaticCache(options.cache_ttl), AKACache(options.aka_cache_size, options.aka_cache))
+
+def notify(state):
+    # sd_notify() of systemd (Type=notify services), nothing without it
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address[0] == '@':
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.connect(address)
+            s.sendall(state.encode())
+    except OSError:
+        pass
+
+def ready(pool):
+    # called when the cards are warm: the server is ready for requests
+    for worker in pool.workers:
+        if not worker.card.connector.present:
+            print('Card ' + str(worker.index) + ' (' + worker.port + ') not available, waiting for it.')
+    available = sum(w.identity is not None for w in pool.workers)
+    print('Ready, ' + str(available) + ' of ' + str(len(pool.workers)) + ' cards.')
+    notify('READY=1\nSTATUS=' + str(available) + ' of ' + str(len(pool.workers)) + ' cards')
+
+def main(argv=None, version=None):
+    # version 1 connects to the card on every request, version 3 uses
+    # card.USIM for the readers; both only serve imsi and rand-autn
+    options = parse_args(argv)
+    operations = REQUEST_TYPES
+    if version == 1:
+        options.on_demand = True
+        operations = BASIC_TYPES
+    elif version == 3:
+        options.usim = (options.usim or []) + (options.reader or [])
+        options.reader = None
+        operations = BASIC_TYPES
+
+    if options.trace is not None:
+        tracer.configure(options.trace, options.trace_format)
+
+    if options.processes > 1:
+        from .shard import supervise
+        supervise(options, operations)
+        return
+    serve(options, operations)
+
+def serve(options, operations, shard=None):
+    # the server of all the cards, or of the cards of one shard (a Shard)
+    if shard is None:
+        pool = build_pool(options)
+    else:
+        pool = build_pool(options, shard.index, shard.count)
+    if len(pool.workers) == 0:
+        print('No modem/reader/emulator. \nExiting.')
+        exit()
+
+    metrics.gauge('usim_queue_depth', lambda: [((('card', w.index),), w.pending) for w in pool.workers])
+    metrics.gauge('usim_card_available', lambda: [((('card', w.index),), int(w.card.connector.available())) for w in pool.workers])
+
+    # The port is open at once (/healthz), and the cards are warmed up all
+    # together while the server runs. /readyz (and systemd) say when they are.
+    if shard is None:
+        server = Server(pool, options.port, options.cert, options.idle_timeout, operations)
+        pool.start(partial(ready, pool))
+    else:
+        server = shard.server(pool, options, operations)
+        pool.start(partial(shard.ready, pool))
+
+    # Cards removed and inserted (or reset), readers and modems unplugged
+    # and plugged again, are followed without restarting the server. The
+    # monitors start after the warm-up jobs are queued, so the cards they
+    # find already there are seen as the ones being warmed up.
+    if any(w.card.connector.transport in ('pyscard', 'card.USIM') for w in pool.workers):
+        from smartcard.CardMonitoring import CardMonitor
+        from smartcard.ReaderMonitoring import ReaderMonitor
+        ReaderMonitor().addObserver(ReaderEventObserver(pool))
+        CardMonitor().addObserver(CardEventObserver(pool))
+    if any(w.card.connector.transport == 'modem' for w in pool.workers):
+        PortMonitor(pool).start()
+
+    server.serve_forever()
@@ -0,0 +1,56 @@
+#hex, BCD and TLV conversions of card data
+#
+# Card data is kept as bytes (or the list of ints of pyscard) until it is
+# put in a response, and then converted once with bytes.hex().
+
+#byte with its nibbles swapped, for BCD (digits are stored low nibble first)
+SWAP = bytes(((b & 0x0F) << 4) | (b >> 4) for b in range(256))
+
+#status byte as two lowercase hex digits
+HEX = tuple('%02x' % b for b in range(256))
+
+
+def bcd(chars):
+    # hex string with the two digits of each byte swapped
+    return bytes.fromhex(chars).translate(SWAP).hex().upper()
+
+def decode_bcd(data):
+    # BCD bytes to digits, the filler F included
+    return bytes(data).translate(SWAP).hex().upper()
+
+def int2hex(num):  #up to 255
+    return HEX[num]
+
+def to_hex(data):
+    # list of bytes to hex string, like toHexString(data).replace(" ", "")
+    return bytes(data).hex().upper()
+
+def to_bytes(hexstring):
+    # hex string to list of bytes, like toBytes(hexstring)
+    return list(bytes.fromhex(hexstring))
+
+
+def parse_aka(data):
+    # AUTHENTICATE response (TS 31.102 7.1.2): DB, then RES, CK, IK (and
+    # Kc) each with its length, or DC and AUTS on synchronisation failure
+    data = memoryview(bytes(data))
+    if len(data) < 2:
+        return None
+    if data[0] == 0xDC:
+        auts = data[2:2 + data[1]]
+        if len(auts) != data[1]:
+            return None
+        return {'status': 'sync-failure', 'auts': auts.hex().upper()}
+    if data[0] != 0xDB:
+        return None
+    values = []
+    i = 1
+    while i < len(data) and len(values) < 4:
+        value = data[i + 1:i + 1 + data[i]]
+        if len(value) != data[i]:
+            return None
+        values.append(value)
+        i += 1 + data[i]
+    if len(values) < 3:
+        return None
+    return {'status': 'ok', 'res': values[0].hex().upper(), 'ck': values[1].hex().upper(), 'ik': values[2].hex().upper()}
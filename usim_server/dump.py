@@ -0,0 +1,129 @@
+#card file system dump
+#
+# walk() goes through the MF, DF_GSM, DF_TELECOM (and their sub DFs) and
+# every application listed in EF_DIR, and reads every EF found. There is
+# no directory listing in a UICC, so the file ids tried in each DF are the
+# ones of ETSI TS 102 221, 3GPP TS 51.011, TS 31.102 (USIM) and TS 31.103
+# (ISIM). Each file is read in its own job of the card worker, so other
+# requests to the card go on during a dump.
+#
+# Files are named by their file ids from the MF (3F007F206F07), or by the
+# AID of their application (A0000000871002FFFFFFFF8903050001/6F07). A dump
+# can be resumed after the last file received (after).
+
+from .card import SELECT_MF, select_fid
+
+#EFs of the MF
+MF_FILES = ('2FE2', '2F05', '2F00', '2F06', '2F08')
+
+#EFs of DF_GSM
+GSM_FILES = (
+    '6F05', '6F07', '6F20', '6F30', '6F31', '6F37', '6F38', '6F39', '6F3E', '6F3F',
+    '6F41', '6F45', '6F46', '6F48', '6F50', '6F52', '6F53', '6F54', '6F60', '6F61',
+    '6F62', '6F63', '6F64', '6F74', '6F78', '6F7B', '6F7E', '6FAD', '6FAE', '6FB7',
+    '6FC5', '6FC6', '6FC7', '6FC9', '6FCA', '6FCB', '6FCD',
+)
+
+#EFs of DF_TELECOM
+TELECOM_FILES = (
+    '6F06', '6F3A', '6F3B', '6F3C', '6F3D', '6F40', '6F42', '6F43', '6F44', '6F47',
+    '6F49', '6F4A', '6F4B', '6F4C', '6F4D', '6F4E', '6F4F', '6F54', '6F58', '6FE0',
+    '6FE1', '6FE5',
+)
+
+#EFs of a phonebook (DF_PHONEBOOK); the ids of most are given by EF_PBR (4F30),
+#these are the usual ones
+PHONEBOOK_FILES = (
+    '4F30', '4F22', '4F23', '4F24', '4F25', '4F26', '4F09', '4F11', '4F12', '4F13',
+    '4F14', '4F15', '4F19', '4F21', '4F3A', '4F4A', '4F50', '4F51', '4F52',
+)
+
+#EFs of the USIM application
+USIM_FILES = (
+    '6F05', '6F06', '6F07', '6F08', '6F09', '6F2C', '6F31', '6F32', '6F37', '6F38',
+    '6F39', '6F3B', '6F3C', '6F3E', '6F3F', '6F40', '6F41', '6F42', '6F43', '6F45',
+    '6F46', '6F47', '6F48', '6F49', '6F4B', '6F4C', '6F4D', '6F4E', '6F4F', '6F50',
+    '6F55', '6F56', '6F57', '6F58', '6F5B', '6F5C', '6F60', '6F61', '6F62', '6F73',
+    '6F78', '6F7B', '6F7E', '6F80', '6F81', '6F82', '6F83', '6FAD', '6FB1', '6FB2',
+    '6FB3', '6FB5', '6FB6', '6FB7', '6FC3', '6FC4', '6FC5', '6FC6', '6FC7', '6FC8',
+    '6FC9', '6FCA', '6FCB', '6FCD', '6FCE', '6FD9', '6FDB', '6FDC', '6FDD', '6FDE',
+    '6FDF', '6FE2', '6FE3', '6FE4', '6FE6', '6FE7', '6FE8', '6FEC', '6FED', '6FEE',
+    '6FEF', '6FF0', '6FF1', '6FF2', '6FF3', '6FF4', '6FF5', '6FF6', '6FF7', '6FF8',
+    '6FF9', '6FFA', '6FFB', '6FFC', '6FFD', '6FFE', '6FFF',
+)
+
+#EFs of the ISIM application
+ISIM_FILES = ('6F02', '6F03', '6F04', '6F06', '6F07', '6F09', '6FAD', '6FD5', '6FD7')
+
+#DFs of the MF (file ids from the MF) and their EFs
+DF_FILES = (
+    ('7F20', GSM_FILES),
+    ('7F10', TELECOM_FILES),
+    ('7F105F3A', PHONEBOOK_FILES),
+    ('7F105F50', ('4F20',)),
+)
+
+#AID prefix (RID and application code): sub DFs (file ids from the ADF) and EFs
+APPLICATIONS = {
+    'A0000000871002': (('', USIM_FILES), ('5F3A', PHONEBOOK_FILES)),
+    'A0000000871004': (('', ISIM_FILES),),
+}
+
+#status of a SELECT of a file that isn't there
+NOT_FOUND = ('6a82', '6a86', '6a87', '6a88')
+
+
+def select_aid(aid):
+    return '00A40404' + '%02X' % (len(aid) // 2) + aid
+
+def fids(hexstring):
+    return [hexstring[i:i + 4] for i in range(0, len(hexstring), 4)]
+
+def plan(aids):
+    # (name, path of SELECTs, name of its DF) of every file to read, in order
+    yield '3F00', (SELECT_MF,), None
+    for fid in MF_FILES:
+        yield '3F00' + fid, (SELECT_MF, select_fid(fid)), '3F00'
+    for df, files in DF_FILES:
+        path = (SELECT_MF,) + tuple(select_fid(fid) for fid in fids(df))
+        parent = '3F00' + df[:-4]
+        yield '3F00' + df, path, parent
+        for fid in files:
+            yield '3F00' + df + fid, path + (select_fid(fid),), '3F00' + df
+    for aid in aids:
+        adf = (SELECT_MF, select_aid(aid))
+        yield aid, adf, '3F00'
+        for df, files in APPLICATIONS.get(aid[:14], ()):
+            path = adf + tuple(select_fid(fid) for fid in fids(df))
+            if df:
+                yield aid + '/' + df, path, aid
+            for fid in files:
+                yield aid + '/' + df + fid, path + (select_fid(fid),), aid + ('/' + df if df else '')
+
+def walk(worker, aids, after=None):
+    # Yields the files found (see card.read_path), one at a time. The
+    # files of a DF that isn't there are not tried. On an error (i.e. the
+    # card is busy or was removed), the last item is the error with the
+    # name of the last file given, to resume the dump after it.
+    missing = set()
+    last = after
+    skipping = after is not None
+    for name, path, parent in plan(aids):
+        if skipping:
+            skipping = name != after
+            continue
+        if parent in missing:
+            missing.add(name)
+            continue
+        try:
+            result = worker.call(worker.card.entry, path, name)
+        except Exception as e:
+            yield {'error': True, 'error_msg': type(e).__name__, 'after': last}
+            return
+        if 'structure' not in result and result['sw1'] + result['sw2'] in NOT_FOUND:
+            missing.add(name)
+            continue
+        last = name
+        yield result
+    if skipping:
+        yield {'error': True, 'error_msg': 'Unknown path ' + after, 'after': after}
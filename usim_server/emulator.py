@@ -0,0 +1,436 @@
+###########################################################
+#
+#                 Software USIM emulator
+#                 ----------------------
+###########################################################
+# A USIM in software, for load tests and CI without a card.
+# EmulatedCard has the same transmit()/getATR() as a pyscard
+# connection, so the servers use it like a smartcard reader.
+#
+# Subscribers are read from a json file:
+# [
+#     {
+#         "imsi": "001010000000001",
+#         "k": "465B5CE8B199B49FAA5F0A2EE238A6BC",
+#         "opc": "CD63CB71954A9F4E48A5994E37A02BAF",    (or "op")
+#         "sqn": "000000000000",                        (optional)
+#         "amf": "8000",                                (optional)
+#         "iccid": "89001010000000000011",              (optional)
+#         "msisdn": "351910000001",                     (optional)
+#         "mnc_length": 2                               (optional)
+#     }
+# ]
+#
+# Authentication uses Milenage (3GPP TS 35.206). TUAK is not
+# supported. The sequence number is checked like TS 33.102
+# Annex C (SEQ and a 5 bit IND), so a replayed or old AUTN
+# gets the sync failure (AUTS) answer, as from a real card.
+#
+# MANAGE CHANNEL opens up to 3 logical channels besides the basic
+# one, each with its own selected file.
+#
+# Run as a script (usim_emulator.py), it prints an authentication vector:
+# python3 usim_emulator.py -k <K> -o <OPc> -s <SQN>
+###########################################################
+
+import json
+import os
+import threading
+import time
+
+from binascii import hexlify, unhexlify
+from optparse import OptionParser
+
+from .codec import bcd
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+
+ATR = '3B9F96801FC78031E073FE211B633A204E8300900031'
+
+AID_USIM = 'A0000000871002FFFFFFFF8903050001'
+
+#logical channels of the card, the basic one included
+CHANNELS = 4
+
+#number of bits of IND in the SQN, and the highest step accepted for SEQ
+IND_BITS = 5
+SEQ_DELTA = 1 << 28
+
+
+#AES-128, from cryptography or pycryptodome when installed
+def rotl8(x, shift):
+    return ((x << shift) | (x >> (8 - shift))) & 0xFF
+
+def make_sbox():
+    # p runs through the multiplicative group, q is its inverse
+    sbox = [0] * 256
+    p = q = 1
+    while True:
+        p = p ^ ((p << 1) & 0xFF) ^ (0x1B if p & 0x80 else 0)
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xFF
+        if q & 0x80:
+            q ^= 0x09
+        sbox[p] = q ^ rotl8(q, 1) ^ rotl8(q, 2) ^ rotl8(q, 3) ^ rotl8(q, 4) ^ 0x63
+        if p == 1:
+            break
+    sbox[0] = 0x63
+    return sbox
+
+SBOX = make_sbox()
+XTIME = [((x << 1) ^ (0x1B if x & 0x80 else 0)) & 0xFF for x in range(256)]
+RCON = (0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1B, 0x36)
+
+
+class PyAES:
+    # AES-128 encryption of single blocks, in pure python
+
+    def __init__(self, key):
+        words = [list(key[i:i + 4]) for i in range(0, 16, 4)]
+        for i in range(4, 44):
+            word = list(words[i - 1])
+            if i % 4 == 0:
+                word = [SBOX[b] for b in word[1:] + word[:1]]
+                word[0] ^= RCON[i // 4 - 1]
+            words.append([a ^ b for a, b in zip(words[i - 4], word)])
+        self.round_keys = [sum(words[4 * r:4 * r + 4], []) for r in range(11)]
+
+    def encrypt(self, block):
+        s = [a ^ b for a, b in zip(block, self.round_keys[0])]
+        for r in range(1, 11):
+            s = [SBOX[b] for b in s]
+            s = [s[(i + 4 * (i % 4)) % 16] for i in range(16)]
+            if r < 10:
+                mixed = []
+                for c in range(0, 16, 4):
+                    a0, a1, a2, a3 = s[c:c + 4]
+                    t = a0 ^ a1 ^ a2 ^ a3
+                    mixed += [a0 ^ t ^ XTIME[a0 ^ a1], a1 ^ t ^ XTIME[a1 ^ a2], a2 ^ t ^ XTIME[a2 ^ a3], a3 ^ t ^ XTIME[a3 ^ a0]]
+                s = mixed
+            s = [a ^ b for a, b in zip(s, self.round_keys[r])]
+        return bytes(s)
+
+
+def aes_encryptor(key):
+    # returns a function encrypting one 16 byte block with key
+    if Cipher is not None:
+        encryptor = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+        return encryptor.update
+    if AES is not None:
+        return AES.new(key, AES.MODE_ECB).encrypt
+    return PyAES(key).encrypt
+
+
+#Milenage
+def xor(a, b):
+    return bytes(x ^ y for x, y in zip(a, b))
+
+def rot(x, bits):  #rotation to the left, bits is a multiple of 8
+    return x[bits // 8:] + x[:bits // 8]
+
+def compute_opc(k, op):
+    return xor(aes_encryptor(k)(op), op)
+
+
+class Milenage:
+
+    def __init__(self, k, opc):
+        self.encrypt = aes_encryptor(k)
+        self.opc = opc
+
+    def out(self, temp, bits, c):
+        # OUT2..OUT5 of TS 35.206
+        return xor(self.encrypt(xor(rot(xor(temp, self.opc), bits), bytes(15) + bytes([c]))), self.opc)
+
+    def f1(self, rand, sqn, amf):
+        # returns MAC-A and MAC-S
+        temp = self.encrypt(xor(rand, self.opc))
+        in1 = sqn + amf + sqn + amf
+        out1 = xor(self.encrypt(xor(temp, rot(xor(in1, self.opc), 64))), self.opc)
+        return out1[:8], out1[8:]
+
+    def f2345(self, rand):
+        # returns RES, CK, IK, AK and AK for the resynchronisation
+        temp = self.encrypt(xor(rand, self.opc))
+        out2 = self.out(temp, 0, 1)
+        out3 = self.out(temp, 32, 2)
+        out4 = self.out(temp, 64, 4)
+        out5 = self.out(temp, 96, 8)
+        return out2[8:], out3, out4, out2[:6], out5[:6]
+
+
+def generate_vector(k, opc, sqn, amf, rand=None):
+    # Network side: returns rand, autn, res, ck, ik (hex) for the given sqn
+    k, opc, sqn, amf = unhexlify(k), unhexlify(opc), unhexlify(sqn), unhexlify(amf)
+    rand = unhexlify(rand) if rand else os.urandom(16)
+    milenage = Milenage(k, opc)
+    res, ck, ik, ak, ak_star = milenage.f2345(rand)
+    mac_a, mac_s = milenage.f1(rand, sqn, amf)
+    autn = xor(sqn, ak) + amf + mac_a
+    return tuple(hexlify(x).decode('utf-8').upper() for x in (rand, autn, res, ck, ik))
+
+
+#card
+class Subscriber:
+    # Keys, sequence numbers and files of one USIM. Shared by all the
+    # connections (EmulatedCard) to it.
+
+    def __init__(self, imsi, k, opc=None, op=None, sqn='000000000000', amf='8000', iccid=None, msisdn=None, mnc_length=2):
+        k = unhexlify(k)
+        opc = unhexlify(opc) if opc else compute_opc(k, unhexlify(op))
+        self.imsi = imsi
+        self.milenage = Milenage(k, opc)
+        self.amf = unhexlify(amf)
+        self.lock = threading.Lock()
+        sqn = int(sqn, 16)
+        self.sqn_ms = sqn
+        self.seq = [sqn >> IND_BITS] * (1 << IND_BITS)
+        self.files = make_files(imsi, iccid or '8900' + imsi[-15:] + '0', msisdn, mnc_length)
+
+    def check_sqn(self, sqn):
+        # TS 33.102 C.2: SEQ must be higher than the last one with the same
+        # IND, and not too far from the highest accepted
+        seq, ind = sqn >> IND_BITS, sqn & ((1 << IND_BITS) - 1)
+        with self.lock:
+            if seq <= self.seq[ind] or seq - (self.sqn_ms >> IND_BITS) > SEQ_DELTA:
+                return False
+            self.seq[ind] = seq
+            self.sqn_ms = max(self.sqn_ms, sqn)
+            return True
+
+    def authenticate(self, rand, autn):
+        # returns the response data, or None on MAC failure
+        res, ck, ik, ak, ak_star = self.milenage.f2345(rand)
+        sqn = xor(autn[:6], ak)
+        mac_a, mac_s = self.milenage.f1(rand, sqn, autn[6:8])
+        if mac_a != autn[8:]:
+            return None
+        if not self.check_sqn(int.from_bytes(sqn, 'big')):
+            sqn_ms = self.sqn_ms.to_bytes(6, 'big')
+            mac_a, mac_s = self.milenage.f1(rand, sqn_ms, bytes(2))
+            auts = xor(sqn_ms, ak_star) + mac_s
+            return b'\xDC' + bytes([len(auts)]) + auts
+        kc = xor(xor(ck[:8], ck[8:]), xor(ik[:8], ik[8:]))
+        return b'\xDB' + bytes([len(res)]) + res + b'\x10' + ck + b'\x10' + ik + b'\x08' + kc
+
+
+def make_files(imsi, iccid, msisdn, mnc_length):
+    # file id: (parent, content), content is bytes for transparent EFs,
+    # a list of records for linear fixed EFs, and None for DFs
+    ef_imsi = unhexlify('08' + bcd('9' + imsi))
+    ef_ad = bytes([0, 0, 0, mnc_length])
+    ef_dir = unhexlify('61184F10' + AID_USIM + '5004' + hexlify(b'USIM').decode() + 'FFFF')
+    number = unhexlify(bcd((msisdn or '').ljust(20, 'F')))
+    ef_msisdn = bytes([len(msisdn) // 2 + len(msisdn) % 2 + 1 if msisdn else 0xFF, 0x91]) + number + b'\xFF\xFF'
+    return {
+        '3F00': (None, None),
+        '2F00': ('3F00', [ef_dir]),
+        '2FE2': ('3F00', unhexlify(bcd(iccid.ljust(20, 'F')))),
+        '7F20': ('3F00', None),
+        '6F07': ('7F20', ef_imsi),
+        '6FAD': ('7F20', ef_ad),
+        '7F10': ('3F00', None),
+        '6F40': ('7F10', [ef_msisdn]),
+        'ADF': ('3F00', None),
+        'ADF/6F07': ('ADF', ef_imsi),
+        'ADF/6FAD': ('ADF', ef_ad),
+        'ADF/6F40': ('ADF', [ef_msisdn]),
+    }
+
+
+class EmulatedCard:
+    # A connection to a Subscriber, like a pyscard connection to a card.
+    # Each APDU takes at least latency seconds (auth_latency for
+    # AUTHENTICATE), to stand in for the time of a real card.
+
+    def __init__(self, subscriber, latency=0, auth_latency=None):
+        self.subscriber = subscriber
+        self.latency = latency
+        self.auth_latency = latency if auth_latency is None else auth_latency
+        self.connect()
+
+    def connect(self, *args, **kwargs):
+        self.current = '3F00'
+        self.response = b''
+        # selected file and pending response of each open logical channel
+        self.channels = {0: (self.current, self.response)}
+
+    def disconnect(self):
+        pass
+
+    def getATR(self):
+        return list(unhexlify(ATR))
+
+    def transmit(self, apdu, protocol=None):
+        apdu = bytes(apdu)
+        start = time.monotonic()
+        data, sw1, sw2 = self.command(apdu)
+        delay = self.auth_latency if len(apdu) > 1 and apdu[1] == 0x88 else self.latency
+        delay -= time.monotonic() - start
+        if delay > 0:
+            time.sleep(delay)
+        return list(data), sw1, sw2
+
+    def command(self, apdu):
+        if len(apdu) < 4:
+            return b'', 0x67, 0x00
+        channel = 4 + (apdu[0] & 0x0F) if apdu[0] & 0x40 else apdu[0] & 0x03
+        if channel not in self.channels:
+            return b'', 0x68, 0x81
+        self.current, self.response = self.channels[channel]
+        try:
+            return self.channel_command(apdu)
+        finally:
+            if channel in self.channels:
+                self.channels[channel] = (self.current, self.response)
+
+    def channel_command(self, apdu):
+        cla, ins, p1, p2 = apdu[:4]
+        if ins == 0x70:
+            return self.manage_channel(p1, p2)
+        if ins != 0xC0:
+            self.response = b''
+        if ins == 0xA4:
+            return self.select(p1, p2, apdu[5:5 + apdu[4]] if len(apdu) > 5 else b'')
+        if ins == 0xB0:
+            return self.read_binary((p1 << 8) | p2, apdu[4] if len(apdu) > 4 else 0)
+        if ins == 0xB2:
+            return self.read_record(p1, p2, apdu[4] if len(apdu) > 4 else 0)
+        if ins == 0x88:
+            return self.authenticate(p2, apdu[5:5 + apdu[4]] if len(apdu) > 5 else b'')
+        if ins == 0xC0:
+            return self.get_response(apdu[4] if len(apdu) > 4 else 0)
+        if ins == 0xF2:
+            return b'', 0x90, 0x00
+        if ins in (0xD6, 0xDC, 0x20, 0x2C, 0x24):
+            return b'', 0x69, 0x82
+        return b'', 0x6D, 0x00
+
+    def manage_channel(self, p1, p2):
+        if p1 == 0x80:
+            if p2 == 0 or p2 not in self.channels:
+                return b'', 0x6A, 0x86
+            del self.channels[p2]
+            return b'', 0x90, 0x00
+        if p1 != 0x00 or p2 != 0x00:
+            return b'', 0x6A, 0x86
+        for channel in range(1, CHANNELS):
+            if channel not in self.channels:
+                self.channels[channel] = ('3F00', b'')
+                return bytes([channel]), 0x90, 0x00
+        return b'', 0x6A, 0x81  #no channel left
+
+    def pending(self, data):
+        # data is given by the next GET RESPONSE
+        self.response = data
+        return b'', 0x61, len(data) & 0xFF
+
+    def select(self, p1, p2, data):
+        files = self.subscriber.files
+        if p1 == 0x04:
+            if len(data) < 5 or not AID_USIM.startswith(hexlify(data).decode('utf-8').upper()):
+                return b'', 0x6A, 0x82
+            self.current = 'ADF'
+            return self.fcp(p2, unhexlify('8202782184') + bytes([len(AID_USIM) // 2]) + unhexlify(AID_USIM))
+        if p1 != 0x00 or len(data) != 2:
+            return b'', 0x6A, 0x86
+        fid = hexlify(data).decode('utf-8').upper()
+        # the MF, or a file in the current DF, in its parent, or the parent itself
+        parent, content = files[self.current]
+        df = self.current if content is None else parent
+        names = [fid]
+        if df == 'ADF':
+            names.insert(0, 'ADF/' + fid)
+        for name in names:
+            if name in files and (name == '3F00' or name == files[df][0] or files[name][0] in (df, files[df][0])):
+                self.current = name
+                parent, content = files[name]
+                if content is None:
+                    return self.fcp(p2, unhexlify('820278218302') + data)
+                if isinstance(content, list):
+                    size = len(content[0]) * len(content)
+                    return self.fcp(p2, unhexlify('8205422100') + bytes([len(content[0]), len(content)]) + unhexlify('8302') + data + unhexlify('8002') + size.to_bytes(2, 'big'))
+                return self.fcp(p2, unhexlify('820241218302') + data + unhexlify('8002') + len(content).to_bytes(2, 'big'))
+        return b'', 0x6A, 0x82
+
+    def fcp(self, p2, template):
+        if p2 & 0x0C == 0x0C:
+            return b'', 0x90, 0x00
+        return self.pending(b'\x62' + bytes([len(template)]) + template)
+
+    def read_binary(self, offset, le):
+        content = self.subscriber.files[self.current][1]
+        if not isinstance(content, bytes):
+            return b'', 0x69, 0x86 if content is None else 0x81
+        if offset > len(content):
+            return b'', 0x6B, 0x00
+        available = len(content) - offset
+        if le == 0 and available != 256 or le > available:
+            return b'', 0x6C, available & 0xFF
+        return content[offset:offset + (le or 256)], 0x90, 0x00
+
+    def read_record(self, record, mode, le):
+        content = self.subscriber.files[self.current][1]
+        if not isinstance(content, list):
+            return b'', 0x69, 0x86 if content is None else 0x81
+        if mode != 0x04 or record < 1 or record > len(content):
+            return b'', 0x6A, 0x83
+        data = content[record - 1]
+        if le != len(data):
+            return b'', 0x6C, len(data)
+        return data, 0x90, 0x00
+
+    def authenticate(self, p2, data):
+        if self.current != 'ADF' and not self.current.startswith('ADF/'):
+            return b'', 0x69, 0x85
+        if p2 != 0x81 or len(data) != 34 or data[0] != 16 or data[17] != 16:
+            return b'', 0x6A, 0x86 if p2 != 0x81 else 0x80
+        response = self.subscriber.authenticate(data[1:17], data[18:34])
+        if response is None:
+            return b'', 0x98, 0x62
+        return self.pending(response)
+
+    def get_response(self, le):
+        if not self.response:
+            return b'', 0x6F, 0x00
+        if le == 0 and len(self.response) != 256 or le > len(self.response):
+            return b'', 0x6C, len(self.response) & 0xFF
+        data, self.response = self.response[:le or 256], self.response[le or 256:]
+        if self.response:
+            return data, 0x61, len(self.response) & 0xFF
+        return data, 0x90, 0x00
+
+
+def load_subscribers(path):
+    with open(path) as f:
+        return [Subscriber(**item) for item in json.load(f)]
+
+
+
+####### Main #######
+def main(argv=None):
+    parser = OptionParser()
+    parser.add_option("-k", "--key", dest="k", help="subscriber key K (hex)")
+    parser.add_option("-o", "--opc", dest="opc", help="OPc (hex)")
+    parser.add_option("-O", "--op", dest="op", help="OP (hex), when OPc is not known")
+    parser.add_option("-s", "--sqn", dest="sqn", default="000000000020", help="sequence number (hex, Default: 000000000020)")
+    parser.add_option("-a", "--amf", dest="amf", default="8000", help="AMF (hex, Default: 8000)")
+    parser.add_option("-R", "--rand", dest="rand", help="RAND (hex, Default: random)")
+    (options, args) = parser.parse_args(argv)
+
+    if options.k is None or (options.opc is None and options.op is None):
+        parser.error('K and OPc (or OP) are needed')
+    opc = options.opc or hexlify(compute_opc(unhexlify(options.k), unhexlify(options.op))).decode('utf-8')
+    rand, autn, res, ck, ik = generate_vector(options.k, opc, options.sqn, options.amf, options.rand)
+    print(json.dumps({'rand': rand, 'autn': autn, 'res': res, 'ck': ck, 'ik': ik}, indent = "\t"))
@@ -0,0 +1,124 @@
+#response formats
+#
+# The format of a response is chosen with the Accept header of the request:
+#
+#   (no Accept), */*, text/*     tab-indented JSON, as always (curl, browsers)
+#   application/json             compact JSON, without indentation
+#   application/cbor             CBOR (needs cbor2)
+#   application/msgpack          MessagePack (needs msgpack)
+#   application/octet-stream     only for type=apdu: the response of the card
+#                                as it is, data followed by SW1 and SW2
+#
+# In CBOR and MessagePack the hex values (res, ck, ik, auts, data, ...)
+# are sent as bytes and sw1/sw2 as integers, so there is nothing to parse.
+# Several types can be given with q values, the first one available is used.
+
+import json
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+#keys with hex values, sent as bytes in the binary formats
+HEX_KEYS = ('res', 'ck', 'ik', 'auts', 'data', 'ad', 'apdu', 'records')
+
+#keys with a status byte, sent as an integer in the binary formats
+SW_KEYS = ('sw1', 'sw2')
+
+DEFAULT = 'json-indent'
+
+#media type: format
+MEDIA_TYPES = {
+    '*/*': DEFAULT,
+    'text/*': DEFAULT,
+    'text/plain': DEFAULT,
+    'application/*': DEFAULT,
+    'application/json': 'json',
+    'application/cbor': 'cbor',
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+    'application/vnd.msgpack': 'msgpack',
+    'application/octet-stream': 'raw',
+}
+
+CONTENT_TYPES = {
+    'json-indent': 'application/json',
+    'json': 'application/json',
+    'cbor': 'application/cbor',
+    'msgpack': 'application/msgpack',
+    'raw': 'application/octet-stream',
+}
+
+
+def available(name, raw=False):
+    if name == 'cbor':
+        return cbor2 is not None
+    if name == 'msgpack':
+        return msgpack is not None
+    if name == 'raw':
+        return raw
+    return True
+
+def negotiate(accept, raw=False):
+    # format for an Accept header, or None when none of its types can be
+    # sent (406). raw tells if the response can be sent as octet-stream.
+    if not accept:
+        return DEFAULT
+    ranges = []
+    for i, part in enumerate(accept.split(',')):
+        media, _, parameters = part.partition(';')
+        q = 1.0
+        for parameter in parameters.split(';'):
+            key, _, value = parameter.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges.append((-q, i, media.strip().lower()))
+    for q, i, media in sorted(ranges):
+        if q >= 0:
+            break
+        name = MEDIA_TYPES.get(media)
+        if name is not None and available(name, raw):
+            return name
+    return None
+
+def binary(value):
+    # hex strings to bytes, status bytes to integers
+    if isinstance(value, list):
+        return [binary(v) for v in value]
+    if isinstance(value, dict):
+        result = {}
+        for k, v in value.items():
+            if k in HEX_KEYS and isinstance(v, str):
+                v = bytes.fromhex(v)
+            elif k in HEX_KEYS and isinstance(v, list):
+                v = [bytes.fromhex(x) for x in v]
+            elif k in SW_KEYS and isinstance(v, str):
+                v = int(v, 16)
+            else:
+                v = binary(v)
+            result[k] = v
+        return result
+    return value
+
+def encode(name, value):
+    # returns the content type and the body of a response
+    if name == 'json':
+        body = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    elif name == 'cbor':
+        body = cbor2.dumps(binary(value))
+    elif name == 'msgpack':
+        body = msgpack.packb(binary(value), use_bin_type=True)
+    elif name == 'raw':
+        body = bytes.fromhex(value['data'] + value['sw1'] + value['sw2'])
+    else:
+        body = json.dumps(value, indent = "\t").encode('utf-8')
+    return CONTENT_TYPES[name], body
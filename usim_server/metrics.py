@@ -0,0 +1,203 @@
+###########################################################
+#
+#         Metrics for the USIM https server API
+#         -------------------------------------
+###########################################################
+# Counters, gauges and histograms, exposed in the Prometheus
+# text format by the /metrics endpoint of the servers:
+#
+# https://<domain | IP address>/metrics
+#
+# usim_requests_total{type="imsi",code="200"} 12
+# usim_request_seconds_bucket{type="imsi",le="0.01"} 10
+# usim_apdu_seconds_bucket{transport="pyscard",command="AUTHENTICATE",le="0.1"} 4
+# (transport is modem, pyscard, card.USIM or emulator)
+# usim_apdu_status_total{transport="pyscard",sw="9000"} 40
+# usim_queue_seconds_bucket{card="0",le="0.01"} 12
+# (the wait for the card, apart from the transmit time in usim_apdu_seconds)
+# usim_coalesced_total{card="0",result="joined"} 3
+# (identical reads sharing the card job of another request)
+# usim_queue_depth{card="0"} 0
+# usim_card_available{card="0"} 1
+# ...
+###########################################################
+
+import threading
+import time
+
+from .tracing import tracer, redact
+
+
+#histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#name: (type, help)
+METRICS = {
+    'usim_requests_total': ('counter', 'HTTP requests by type and status code'),
+    'usim_request_seconds': ('histogram', 'HTTP request latency (end to end) by type'),
+    'usim_errors_total': ('counter', 'Exceptions answered as errors, by request type and exception'),
+    'usim_apdu_seconds': ('histogram', 'APDU transmit latency by transport and command'),
+    'usim_apdu_status_total': ('counter', 'APDU status words by transport'),
+    'usim_queue_seconds': ('histogram', 'Time a job waited for the worker of its card, by card'),
+    'usim_coalesced_total': ('counter', 'Card reads run for a request (sent) or shared with an identical one already running (joined), by card'),
+    'usim_queue_depth': ('gauge', 'Requests waiting for or running on each card'),
+    'usim_card_reconnects_total': ('counter', 'Connections to a card established again, by card and port'),
+    'usim_aka_cache_total': ('counter', 'rand-autn requests answered from the AKA cache (hit) or by the card (miss)'),
+    'usim_card_available': ('gauge', 'Whether each card is present and could be opened (1) or not (0)'),
+}
+
+#instruction byte: command name
+COMMANDS = {
+    0xA4: 'SELECT',
+    0xB0: 'READ BINARY',
+    0xB2: 'READ RECORD',
+    0xD6: 'UPDATE BINARY',
+    0xDC: 'UPDATE RECORD',
+    0x88: 'AUTHENTICATE',
+    0x89: 'AUTHENTICATE',
+    0xC0: 'GET RESPONSE',
+    0xF2: 'STATUS',
+    0x70: 'MANAGE CHANNEL',
+    0x20: 'VERIFY PIN',
+    0x2C: 'UNBLOCK PIN',
+    0x10: 'TERMINAL PROFILE',
+    0x12: 'FETCH',
+    0x14: 'TERMINAL RESPONSE',
+    0xC2: 'ENVELOPE',
+}
+
+#status words whose sw2 is a length, counted together (i.e. 61XX)
+SW1_LENGTH = (0x61, 0x6C, 0x9F, 0x91)
+
+
+def command_name(apdu):
+    if len(apdu) < 2:
+        return 'OTHER'
+    return COMMANDS.get(apdu[1], 'OTHER')
+
+def status_word(sw1, sw2):
+    if sw1 in SW1_LENGTH:
+        return '%02X' % sw1 + 'XX'
+    return '%02X%02X' % (sw1, sw2)
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, tuple(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i in range(len(BUCKETS)):
+                if seconds <= BUCKETS[i]:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def gauge(self, name, function):
+        # function() returns a list of (labels, value), read on every scrape
+        self.gauges[name] = function
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: ([*h[0]], h[1], h[2]) for key, h in self.histograms.items()}
+        lines = []
+        for name, (kind, help) in METRICS.items():
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            if kind == 'counter':
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(name + format_labels(labels) + ' ' + str(value))
+            elif kind == 'gauge' and name in self.gauges:
+                for labels, value in self.gauges[name]():
+                    lines.append(name + format_labels(labels) + ' ' + str(value))
+            elif kind == 'histogram':
+                for (n, labels), (buckets, total, count) in sorted(histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, value in zip(BUCKETS, buckets):
+                        lines.append(name + '_bucket' + format_labels(labels + (('le', str(bound)),)) + ' ' + str(value))
+                    lines.append(name + '_bucket' + format_labels(labels + (('le', '+Inf'),)) + ' ' + str(count))
+                    lines.append(name + '_sum' + format_labels(labels) + ' ' + repr(total))
+                    lines.append(name + '_count' + format_labels(labels) + ' ' + str(count))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in labels) + '}'
+
+
+#the registry used by the servers
+metrics = Metrics()
+
+
+def observe_apdu(transport, apdu, sw1, sw2, seconds):
+    metrics.observe('usim_apdu_seconds', seconds, (('transport', transport), ('command', command_name(apdu))))
+    metrics.inc('usim_apdu_status_total', (('transport', transport), ('sw', status_word(sw1, sw2))))
+
+
+class MeteredConnection:
+    # Wraps a pyscard connection or a ModemTransport, timing every transmit()
+    # (and tracing it, in a traced request).
+
+    def __init__(self, connection, transport):
+        self.connection = connection
+        self.transport = transport
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def transmit(self, apdu, protocol=None):
+        span = None
+        if tracer.current() is not None:
+            span = tracer.start('apdu', transport=self.transport, command=command_name(apdu), apdu=redact(apdu))
+        start = time.monotonic()
+        try:
+            data, sw1, sw2 = self.connection.transmit(apdu)
+        except Exception as e:
+            if span is not None:
+                tracer.end(span, error=type(e).__name__)
+            raise
+        observe_apdu(self.transport, apdu, sw1, sw2, time.monotonic() - start)
+        if span is not None:
+            tracer.end(span, response_length=len(data), sw='%02X%02X' % (sw1, sw2))
+        return data, sw1, sw2
+
+
+class APDUObserver:
+    # pyscard connection observer (connection.addObserver()), for connections
+    # used by other libraries, like the one inside card.USIM.
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.apdu = []
+        self.start = 0
+        self.span = None
+
+    def update(self, connection, event):
+        if event.type == 'command':
+            self.apdu = event.args[0]
+            self.start = time.monotonic()
+            if tracer.current() is not None:
+                self.span = tracer.start('apdu', transport=self.transport, command=command_name(self.apdu), apdu=redact(self.apdu))
+        elif event.type == 'response':
+            data, sw1, sw2 = event.args
+            observe_apdu(self.transport, self.apdu, sw1, sw2, time.monotonic() - self.start)
+            span, self.span = self.span, None
+            tracer.end(span, response_length=len(data), sw='%02X%02X' % (sw1, sw2))
@@ -0,0 +1,497 @@
+#card pool
+#
+# One CardWorker (thread) per card runs the jobs for it, one at a time.
+# The CardPool routes requests to the workers and keeps the static card
+# data in a StaticCache, and the last authentications in an AKACache.
+# A Session is a logical channel of a card, given to one client.
+
+import asyncio
+import queue
+import secrets
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future, wait
+from functools import partial
+
+from .card import res_ck_ik
+from .codec import to_hex
+from .metrics import metrics
+from .tracing import tracer
+from .transport import CardUnavailable
+
+#seconds between the checks of the modem ports (PortMonitor):
+MONITOR_INTERVAL = 1
+
+#seconds a session can be idle before its logical channel is closed:
+SESSION_TIMEOUT = 60
+
+
+class CardBusy(Exception):
+    pass
+
+
+class CardWorker(threading.Thread):
+    # Owns the connection to one card. Jobs are run one at a time in this
+    # thread, so APDUs from different requests never interleave on the card.
+    # At most max_queue jobs can wait, after that submit() raises CardBusy.
+    # control() jobs (card removed, inserted or reset) are never refused:
+    # the connection is only opened, reset and closed in this thread.
+    # call() waits for the result in the calling thread, acall() in an
+    # asyncio event loop, so one loop can wait on many cards at once.
+    # share() is call() for reads: requests with the same key while one is
+    # running or waiting get its result, the card only runs it once.
+    # A job submitted in a traced request runs in its trace (card.queue is
+    # the time it waited, card.job the time it ran).
+
+    def __init__(self, index, card, max_queue=0):
+        super().__init__(name='card-' + str(index), daemon=True)
+        self.index = index
+        self.card = card
+        self.port = card.connector.name
+        self.imsi = None
+        self.identity = None
+        self.pending = 0
+        self.done = 0
+        self.max_queue = max_queue
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        # key: Future of the jobs given to share() not done yet
+        self.flights = {}
+        self.flights_lock = threading.Lock()
+
+    def submit(self, function, *args):
+        # function(*args) is called in the worker thread, i.e. a method of self.card
+        return self.enqueue(function, args, self.max_queue)
+
+    def control(self, function, *args):
+        return self.enqueue(function, args, 0)
+
+    def enqueue(self, function, args, limit):
+        future = Future()
+        with self.lock:
+            if limit and self.jobs.qsize() >= limit:
+                raise CardBusy()
+            self.pending += 1
+            self.jobs.put((future, function, args, tracer.current(), time.monotonic_ns()))
+        return future
+
+    def call(self, function, *args):
+        return self.submit(function, *args).result()
+
+    def share(self, key, function, *args):
+        # A job already done (its callback not run yet) isn't joined: its
+        # result may be older than a write the caller saw complete.
+        with self.flights_lock:
+            future = self.flights.get(key)
+            joined = future is not None and not future.done()
+            if not joined:
+                future = self.flights[key] = self.submit(function, *args)
+        # outside the lock, the callback runs at once if the job is done
+        if not joined:
+            future.add_done_callback(partial(self.landed, key))
+        metrics.inc('usim_coalesced_total', (('card', self.index), ('result', 'joined' if joined else 'sent')))
+        return future.result()
+
+    def landed(self, key, future):
+        with self.flights_lock:
+            if self.flights.get(key) is future:
+                del self.flights[key]
+
+    async def acall(self, function, *args):
+        # await worker.acall(worker.card.res_ck_ik, rand, autn)
+        return await asyncio.wrap_future(self.submit(function, *args))
+
+    def run(self):
+        while True:
+            future, function, args, span, queued = self.jobs.get()
+            waited = time.monotonic_ns() - queued
+            metrics.observe('usim_queue_seconds', waited / 1e9, (('card', self.index),))
+            tracer.record('card.queue', span, time.time_ns() - waited, card=self.index)
+            previous = tracer.activate(span)
+            try:
+                if future.set_running_or_notify_cancel():
+                    # the span ends before the request waiting for the result goes on
+                    job = tracer.start('card.job', card=self.index, job=getattr(function, '__name__', 'job'))
+                    try:
+                        result = function(*args)
+                    except BaseException as e:
+                        tracer.end(job, error=type(e).__name__)
+                        future.set_exception(e)
+                    else:
+                        tracer.end(job)
+                        future.set_result(result)
+            finally:
+                tracer.activate(previous)
+                with self.lock:
+                    self.pending -= 1
+                    self.done += 1
+
+
+class Session:
+    # A logical channel of the card of worker, used by one client with the
+    # token. Its selection is its own, other requests don't change it.
+    # The token starts with the card index (see card_of()).
+
+    def __init__(self, worker, channel):
+        self.token = str(worker.index) + '-' + secrets.token_hex(16)
+        self.worker = worker
+        self.channel = channel
+        self.last_used = time.monotonic()
+
+    def expired(self):
+        return time.monotonic() - self.last_used > SESSION_TIMEOUT
+
+    @staticmethod
+    def card_of(token):
+        # index of the card of a session token, None if it has none
+        index = token.split('-', 1)[0]
+        return int(index) if index.isdigit() else None
+
+
+class CardPool:
+
+    def __init__(self, workers, cache, vectors=None):
+        self.workers = workers
+        self.cache = cache
+        self.vectors = vectors
+        self.sessions = {}
+        self.lock = threading.Lock()
+        # set when all the cards were warmed up at startup (see start())
+        self.ready = threading.Event()
+
+    def start(self, on_ready=None):
+        # The cards are opened and their static data read upfront, all at
+        # once (each in its worker), the imsi is also needed to route
+        # requests by imsi. Without on_ready, this waits until they are all
+        # warm, otherwise on_ready() is called then, from another thread.
+        for worker in self.workers:
+            worker.start()
+        futures = [self.warm(worker) for worker in self.workers]
+        if on_ready is None:
+            self.warmed(futures)
+        else:
+            threading.Thread(target=self.warmed, args=(futures, on_ready), name='warm-up', daemon=True).start()
+
+    def warmed(self, futures, on_ready=None):
+        wait(futures)
+        self.ready.set()
+        if on_ready is not None:
+            on_ready()
+
+    def warm(self, worker):
+        # opens the card and reads its static data in its worker (Future)
+        return worker.submit(self.load, worker)
+
+    def load(self, worker):
+        # in the worker thread. A card that can't be opened is waited for,
+        # like a removed one, until the monitors see it (card_event).
+        connector = worker.card.connector
+        try:
+            self.loaded(worker, *worker.card.warm())
+        except CardUnavailable:
+            if connector.present and connector.connection is None:
+                connector.present = False
+        except Exception as e:
+            # the card is read again by the first request that needs it
+            print('Card ' + str(worker.index) + ' (' + worker.port + ') warm-up failed: ' + type(e).__name__ + ' ' + str(e))
+
+    def is_ready(self):
+        # warm, and with at least one card to serve requests
+        return self.ready.is_set() and any(w.identity is not None and w.card.connector.available() for w in self.workers)
+
+    def loaded(self, worker, identity, files):
+        self.cache.put(identity, files)
+        worker.identity = identity
+        worker.imsi = files['imsi']
+
+    def static(self, worker):
+        # static card data, only read from the card when not in the cache
+        files = None
+        if worker.identity is not None:
+            files = self.cache.get(worker.identity)
+        if files is None:
+            identity, files = worker.share('static', worker.card.static)
+            self.loaded(worker, identity, files)
+        return files
+
+    def imsi(self, worker):
+        # without a kept connection the card can change between requests,
+        # so nothing is cached
+        if not worker.card.connector.persistent:
+            return worker.share('imsi', worker.card.imsi)
+        return self.static(worker)['imsi']
+
+    def res_ck_ik(self, worker, rand, autn):
+        # A rand/autn the card already answered (a client retrying after a
+        # timeout) is answered from the AKA cache, without AUTHENTICATE. As
+        # for the imsi, nothing is cached without a kept connection. The
+        # same rand/autn sent again while the card runs it waits for it
+        # (a second AUTHENTICATE would only be a synchronisation failure).
+        if self.vectors is None or not worker.card.connector.persistent:
+            return worker.share(('rand-autn', rand.upper(), autn.upper()), worker.card.res_ck_ik, rand, autn)
+        key = (worker.index, rand.upper(), autn.upper())
+        result = self.vectors.get(key)
+        metrics.inc('usim_aka_cache_total', (('result', 'miss' if result is None else 'hit'),))
+        if result is None:
+            result = worker.share(('aka',) + key[1:], worker.card.aka, rand, autn)
+            if result.get('status') == 'ok':
+                self.vectors.put(key, result)
+        return res_ck_ik(result)
+
+    def forget(self, worker):
+        # called when the card of worker was removed, reset or written to
+        self.cache.invalidate(worker.identity)
+        worker.identity = None
+        if self.vectors is not None:
+            self.vectors.invalidate(worker.index)
+
+    def open_session(self, worker):
+        # None when the card has no free logical channel
+        for session in self.worker_sessions(worker):
+            if session.expired():
+                self.close_session(session)
+        channel = worker.call(worker.card.open_channel)
+        if channel is None:
+            return None
+        session = Session(worker, channel)
+        with self.lock:
+            self.sessions[session.token] = session
+        return session
+
+    def session(self, token):
+        with self.lock:
+            session = self.sessions.get(token)
+        if session is not None and session.expired():
+            self.close_session(session)
+            return None
+        if session is not None:
+            session.last_used = time.monotonic()
+        return session
+
+    def close_session(self, session):
+        with self.lock:
+            if self.sessions.pop(session.token, None) is None:
+                return
+        try:
+            session.worker.call(session.worker.card.close_channel, session.channel)
+        except Exception:
+            pass
+
+    def worker_sessions(self, worker):
+        with self.lock:
+            return [s for s in self.sessions.values() if s.worker is worker]
+
+    def drop_sessions(self, worker):
+        # the card was removed or reset, its channels are already closed
+        with self.lock:
+            for session in [s for s in self.sessions.values() if s.worker is worker]:
+                del self.sessions[session.token]
+
+    def card_event(self, name, removed=False, atr=None):
+        # A card (or its reader or modem) was removed or inserted. Requests
+        # to a removed card fail at once (CardUnavailable), and an inserted
+        # one is read again, it may be another card. The connection itself
+        # is changed by a job of the worker (see CardWorker.control()).
+        for worker in self.workers:
+            if worker.port != name:
+                continue
+            connector = worker.card.connector
+            if removed:
+                connector.present = False
+                self.forget(worker)
+                self.drop_sessions(worker)
+                worker.control(connector.removed)
+            elif not connector.present:
+                connector.present = True
+                worker.control(self.insert, worker)
+            elif atr is None or worker.identity is None or worker.identity[0] != atr:
+                # the monitor of pyscard also says "added" for the cards
+                # already there, the same ATR is the same card
+                worker.control(self.reset, worker, atr)
+
+    def insert(self, worker):
+        # in the worker thread
+        worker.card.connector.inserted()
+        self.forget(worker)
+        self.load(worker)
+
+    def reset(self, worker, atr=None):
+        # In the worker thread. The card was reset, or another one was
+        # inserted: its logical channels are closed (if it still has them)
+        # and it is read again. Checked again here, the warm-up may have
+        # read the card since the event.
+        if atr is not None and worker.identity is not None and worker.identity[0] == atr:
+            return
+        connector = worker.card.connector
+        if connector.connection is not None:
+            try:
+                worker.card.release([s.channel for s in self.worker_sessions(worker)])
+            except Exception:
+                pass
+        connector.invalidate()
+        self.forget(worker)
+        self.drop_sessions(worker)
+        self.load(worker)
+
+    def reader_event(self, name, removed=False):
+        # A reader was plugged or unplugged. A reader not found at startup
+        # gets its name when it is plugged; the card in it, if any, then
+        # comes with a card event.
+        if removed:
+            self.card_event(name, removed=True)
+            return
+        for worker in self.workers:
+            connector = worker.card.connector
+            if worker.port != name and connector.locate is not None and connector.locate() == name:
+                worker.port = connector.name = name
+
+    def select(self, imsi=None, card=None):
+        if card is not None:
+            # the index of a card is its place in the pool, or in all the
+            # pools of a sharded server (see shard.py)
+            index = int(card)
+            for worker in self.workers:
+                if worker.index == index:
+                    return worker
+            return None
+        if imsi is not None:
+            for worker in self.workers:
+                if worker.imsi == imsi:
+                    return worker
+            return None
+        return min(self.workers, key=lambda worker: (worker.pending, worker.done))
+
+    def cards(self):
+        return [{'card': w.index, 'port': w.port, 'imsi': w.imsi, 'pending': w.pending, 'available': w.card.connector.available(), 'sessions': len(self.worker_sessions(w))} for w in self.workers]
+
+
+#static card data cache
+class StaticCache:
+    # Read-only card data (IMSI, ICCID, EF_AD, MSISDN) by card identity.
+    # With a ttl (seconds), older entries are read again from the card.
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, identity):
+        with self.lock:
+            entry = self.entries.get(identity)
+        if entry is None:
+            return None
+        files, loaded = entry
+        if self.ttl and time.monotonic() - loaded > self.ttl:
+            return None
+        return files
+
+    def put(self, identity, files):
+        with self.lock:
+            self.entries[identity] = (files, time.monotonic())
+
+    def invalidate(self, identity):
+        with self.lock:
+            self.entries.pop(identity, None)
+
+
+#authentication results cache
+class AKACache:
+    # RES, CK and IK of the last authentications by (card, RAND, AUTN).
+    # At most size entries (the least recently used ones are dropped first),
+    # each kept ttl seconds. The values are kept in bytearrays, overwritten
+    # with zeros when the entry is dropped.
+
+    def __init__(self, size=1024, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            values, stored = entry
+            if time.monotonic() - stored > self.ttl:
+                self.drop(key)
+                return None
+            self.entries.move_to_end(key)
+            res, ck, ik = (value.hex().upper() for value in values)
+        return {'status': 'ok', 'res': res, 'ck': ck, 'ik': ik}
+
+    def put(self, key, result):
+        if self.size <= 0 or self.ttl <= 0:
+            return
+        values = tuple(bytearray.fromhex(result[k]) for k in ('res', 'ck', 'ik'))
+        with self.lock:
+            now = time.monotonic()
+            for old in [k for k, (v, stored) in self.entries.items() if now - stored > self.ttl or k == key]:
+                self.drop(old)
+            self.entries[key] = (values, now)
+            while len(self.entries) > self.size:
+                self.drop(next(iter(self.entries)))
+
+    def invalidate(self, card):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == card]:
+                self.drop(key)
+
+    def drop(self, key):
+        # with the lock held
+        values, stored = self.entries.pop(key)
+        for value in values:
+            value[:] = bytes(len(value))
+
+
+class CardEventObserver:
+    # pyscard calls update() on card insertion and removal
+    # (CardMonitor().addObserver())
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def update(self, observable, handlers):
+        added, removed = handlers
+        for card in added:
+            self.pool.card_event(str(card.reader), atr=to_hex(card.atr))
+        for card in removed:
+            self.pool.card_event(str(card.reader), removed=True)
+
+
+class ReaderEventObserver:
+    # pyscard calls update() when readers are plugged and unplugged
+    # (ReaderMonitor().addObserver())
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def update(self, observable, handlers):
+        added, removed = handlers
+        for reader in removed:
+            self.pool.reader_event(str(reader), removed=True)
+        for reader in added:
+            self.pool.reader_event(str(reader))
+
+
+class PortMonitor(threading.Thread):
+    # Checks every interval seconds that the port of each modem is still
+    # there (locate()), and tells the pool when it goes away or comes back.
+
+    def __init__(self, pool, interval=MONITOR_INTERVAL):
+        super().__init__(name='port-monitor', daemon=True)
+        self.pool = pool
+        self.interval = interval
+
+    def run(self):
+        while True:
+            for worker in self.pool.workers:
+                connector = worker.card.connector
+                if connector.transport != 'modem' or connector.locate is None:
+                    continue
+                present = connector.locate() is not None
+                if present != connector.present:
+                    self.pool.card_event(worker.port, removed=not present)
+            time.sleep(self.interval)
@@ -0,0 +1,431 @@
+#https server
+#
+# The API (see the header of usim_https_server_v2.py) on top of a CardPool.
+
+import ssl
+import socket
+import json
+import time
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from functools import partial
+
+from .card import writes, reads
+from .dump import walk
+from .formats import DEFAULT, negotiate, encode
+from .metrics import metrics
+from .pool import CardBusy
+from .tracing import tracer
+from .transport import CardUnavailable
+
+#path for the server.pem file:
+PATH = '/home/user/https/server.pem'
+
+#maximum number of items in a batch or script request:
+MAX_BATCH = 64
+
+#seconds a client is told to wait (Retry-After) when the card queue is full:
+RETRY_AFTER = 1
+
+#request types (other types are counted as 'other' in the metrics)
+REQUEST_TYPES = ('imsi', 'card-info', 'rand-autn', 'apdu', 'cards', 'batch', 'script', 'open-session', 'close-session', 'file', 'dump')
+
+
+def apdu_hex(value):
+    # True for the hex string of an APDU (at least CLA, INS, P1 and P2)
+    try:
+        return isinstance(value, str) and len(bytes.fromhex(value)) >= 4
+    except ValueError:
+        return False
+
+def script_items(apdus):
+    # The APDUs of a script as {"hex", "expect"} items (a hex string is an
+    # item without expect, and an expect string a list of one), None if
+    # one of them isn't valid.
+    items = []
+    for item in apdus:
+        if not isinstance(item, dict):
+            item = {'hex': item}
+        expect = item.get('expect')
+        if isinstance(expect, str):
+            item = dict(item, expect=[expect])
+        elif expect is not None and not (isinstance(expect, list) and all(isinstance(sw, str) for sw in expect)):
+            return None
+        if not apdu_hex(item.get('hex')):
+            return None
+        items.append(item)
+    return items
+
+
+class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+
+    def __init__(self, pool, operations, *args, **kwargs):
+        self.pool = pool
+        self.operations = operations
+
+        # BaseHTTPRequestHandler calls do_GET **inside** __init__ !!!
+        # So we have to call super().__init__ after setting attributes.
+        super().__init__(*args, **kwargs)
+
+    # HTTP/1.1 keeps the connection (and its TLS session) open between requests
+    protocol_version = "HTTP/1.1"
+
+    # idle connections are closed after these seconds (slow TLS handshakes included)
+    timeout = 30
+
+    # The headers and the body of a response are buffered, and sent in one
+    # write when the request is done. Written separately, the body waited
+    # for the delayed ACK of the headers (Nagle), ~40 ms per request.
+    wbufsize = 65536
+
+    format = DEFAULT
+
+    session = None
+
+    #root span of the request being served (see usim_server/tracing.py)
+    trace = None
+
+    status = 0
+
+    #the Router of a sharded server (see usim_server/shard.py), that sends
+    #the requests for the cards of other processes to them
+    router = None
+
+    #the request was answered by another shard (and is measured there)
+    forwarded = False
+
+    def handle(self):
+        # The TLS handshake is done here, in the thread of this connection,
+        # and not in accept(), so that a slow client doesn't block the others.
+        if not isinstance(self.request, ssl.SSLSocket):  #internal listener of a shard
+            super().handle()
+            return
+        span = tracer.start('tls.handshake', root=True)
+        try:
+            self.request.do_handshake()
+        except (ssl.SSLError, OSError) as e:
+            tracer.end(span, error=type(e).__name__)
+            return
+        if span is not None:
+            tracer.end(span, version=self.request.version(), cipher=self.request.cipher()[0], resumed=self.request.session_reused)
+        super().handle()
+
+    def parse_request(self):
+        # the trace of a request starts when its request line is received
+        self.status = 0
+        self.forwarded = False
+        self.trace = tracer.start('http.request', root=True)
+        with tracer.span('http.parse'):
+            return super().parse_request()
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            trace, self.trace = self.trace, None
+            if trace is not None:
+                tracer.end(trace, method=self.command or '', code=self.status)
+
+    def send(self, code, value, retry_after=None):
+        # value in the format of the Accept header (errors are never raw)
+        self.status = code
+        try:
+            name = DEFAULT if self.format == 'raw' and code != 200 else self.format
+            with tracer.span('serialize', format=name) as span:
+                content_type, message = encode(name, value)
+                if span is not None:
+                    span.attributes['length'] = len(message)
+            self.send_response(code)
+            self.send_header("Content-type", content_type)
+            self.send_header("Content-Length", str(len(message)))
+            self.send_header("Vary", "Accept")
+            if retry_after is not None:
+                self.send_header("Retry-After", str(retry_after))
+            self.end_headers()
+            self.wfile.write(message)
+
+        except socket.error:
+            pass
+
+    def API_Error(self, error_code, error_msg, retry_after=None):
+        self.send(error_code, {"error": True,"error_code":error_code,"error_msg":error_msg}, retry_after)
+
+    def API_Ok(self, value):
+        self.send(200, value)
+
+    def API_Stream(self, values):
+        # JSON lines, each one sent as soon as it is there (chunked), so a
+        # long response is neither buffered nor waited for
+        self.status = 200
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for value in values:
+                line = json.dumps(value, separators=(',', ':')).encode('utf-8') + b'\n'
+                self.wfile.write(b'%X\r\n' % len(line) + line + b'\r\n')
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+
+        except socket.error:
+            self.close_connection = True
+
+    def API_Metrics(self):
+        try:
+            self.status = 200
+            message = metrics.render()
+            if self.router is not None:
+                message = self.router.metrics(message)
+            message = message.encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(message)))
+            self.end_headers()
+            self.wfile.write(message)
+
+        except socket.error:
+            pass
+
+    def measure(self, params, start):
+        if self.forwarded:
+            return
+        request_type = params.get('type') if params.get('type') in REQUEST_TYPES else 'other'
+        if self.trace is not None:
+            self.trace.attributes['type'] = request_type
+        metrics.observe('usim_request_seconds', time.monotonic() - start, (('type', request_type),))
+        metrics.inc('usim_requests_total', (('type', request_type), ('code', str(self.status))))
+
+    def error(self, params, e):
+        request_type = params.get('type') if params.get('type') in REQUEST_TYPES else 'other'
+        metrics.inc('usim_errors_total', (('type', request_type), ('error', type(e).__name__)))
+        self.API_Error(501, "Error")
+
+    def accept(self, params):
+        # format of the response (Accept header), False after answering 406
+        self.format = negotiate(self.headers.get('Accept'), params.get('type') == 'apdu')
+        if self.format is None:
+            self.format = DEFAULT
+            self.API_Error(406, "Not acceptable")
+            return False
+        return True
+
+    def worker(self, params):
+        # the card for the request (the card of the session, if one is
+        # given), or None after answering an error
+        self.session = None
+        if params['type'] not in self.operations:
+            self.API_Error(501, "Error")
+            return None
+        if 'session' in params:
+            self.session = self.pool.session(params['session'])
+            if self.session is None:
+                self.API_Error(404, "Unknown session")
+                return None
+            worker = self.session.worker
+        else:
+            worker = self.pool.select(params.get('imsi'), params.get('card'))
+        if worker is None:
+            self.API_Error(404, "Unknown card")
+        elif params['type'] not in worker.card.operations:
+            self.API_Error(501, "Not supported by the card")
+            return None
+        elif not worker.card.connector.available():
+            raise CardUnavailable(worker.port)
+        return worker
+
+    def API_Health(self, path):
+        # /healthz: the server is up, /readyz: and its cards are warm
+        # (for a supervisor or a load balancer)
+        self.format = DEFAULT
+        if path == '/healthz':
+            self.API_Ok({'status': 'ok'})
+        elif self.pool.is_ready() if self.router is None else self.router.is_ready():
+            self.API_Ok({'ready': True, 'cards': sum(w.card.connector.available() for w in self.pool.workers)})
+        else:
+            self.send(503, {'ready': False}, RETRY_AFTER)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/metrics':
+            self.API_Metrics()
+            return
+        if path in ('/healthz', '/readyz'):
+            self.API_Health(path)
+            return
+        start = time.monotonic()
+        self.format = DEFAULT
+        params = {}
+        try:
+            params = {k: v[0] for k, v in parse_qs(urlsplit(self.path).query).items()}
+            if self.router is not None and self.router.route(self, params):
+                return
+            if not self.accept(params):
+                return
+            if params['type'] == 'cards' and 'cards' in self.operations:
+                cards = self.pool.cards()
+                if self.router is not None:
+                    cards = self.router.cards(cards)
+                self.API_Ok(cards)
+                return
+            worker = self.worker(params)
+            if worker is None:
+                pass
+            elif params['type'] == 'imsi':
+                imsi = self.pool.imsi(worker)
+                self.API_Ok({'imsi': imsi})
+            elif params['type'] == 'card-info':
+                self.API_Ok(self.pool.static(worker))
+            elif params['type'] == 'rand-autn':
+                rand = params['rand']
+                autn = params['autn']
+                res, ck, ik = self.pool.res_ck_ik(worker, rand, autn)
+                self.API_Ok({'res': res, 'ck': ck, 'ik': ik})
+            elif params['type'] == 'apdu':
+                hexstring = params['hex']
+                if self.session is not None:
+                    data, sw1, sw2 = worker.call(worker.card.channel_apdu, self.session.channel, hexstring)
+                elif reads(hexstring):
+                    data, sw1, sw2 = worker.share(('apdu', hexstring.upper()), worker.card.apdu, hexstring)
+                else:
+                    data, sw1, sw2 = worker.call(worker.card.apdu, hexstring)
+                if writes(hexstring):
+                    self.pool.forget(worker)
+                self.API_Ok({'data': data, 'sw1': sw1, 'sw2': sw2})
+            elif params['type'] == 'file':
+                self.API_Ok(worker.share(('file', params['path'].upper()), worker.card.file, params['path']))
+            elif params['type'] == 'dump':
+                aids = worker.call(worker.card.applications)
+                self.API_Stream(walk(worker, aids, params.get('after')))
+            elif params['type'] == 'open-session':
+                session = self.pool.open_session(worker)
+                if session is None:
+                    self.API_Error(503, "No free logical channel", RETRY_AFTER)
+                else:
+                    self.API_Ok({'session': session.token, 'card': worker.index, 'channel': session.channel})
+            elif params['type'] == 'close-session':
+                if self.session is None:
+                    self.API_Error(400, "Expected a session")
+                else:
+                    self.pool.close_session(self.session)
+                    self.API_Ok({'session': self.session.token, 'closed': True})
+
+            else:
+                self.API_Error(501, "Error")
+        except CardBusy:
+            self.API_Error(503, "Card busy", RETRY_AFTER)
+        except CardUnavailable:
+            self.API_Error(503, "Card not available", RETRY_AFTER)
+        except Exception as e:
+            self.error(params, e)
+        finally:
+            self.measure(params, start)
+
+    def do_POST(self):
+        start = time.monotonic()
+        self.format = DEFAULT
+        params = {}
+        try:
+            params = {k: v[0] for k, v in parse_qs(urlsplit(self.path).query).items()}
+            length = int(self.headers.get('Content-Length', 0))
+            raw = self.rfile.read(length)
+            if self.router is not None and self.router.route(self, params, raw):
+                return
+            body = json.loads(raw.decode('utf-8'))
+            if not self.accept(params):
+                return
+            worker = self.worker(params)
+            if worker is None:
+                pass
+            elif params['type'] == 'batch':
+                if not isinstance(body, list) or len(body) > MAX_BATCH:
+                    self.API_Error(400, "Expected a list of at most " + str(MAX_BATCH) + " items")
+                    return
+                # checked before the card runs anything (AUTHENTICATE uses up a SQN)
+                if not all(isinstance(item, dict) and ('apdu' not in item or apdu_hex(item['apdu'])) for item in body):
+                    self.API_Error(400, "Expected a list of objects with rand and autn, or apdu")
+                    return
+                written = any('apdu' in item and writes(item['apdu']) for item in body)
+                try:
+                    results = worker.call(worker.card.batch, body)
+                finally:
+                    # also when the job failed half way, the writes may be done
+                    if written:
+                        self.pool.forget(worker)
+                self.API_Ok(results)
+            elif params['type'] == 'script':
+                if isinstance(body, list):
+                    body = {'apdus': body}
+                apdus = body.get('apdus') if isinstance(body, dict) else None
+                if not isinstance(apdus, list) or len(apdus) > MAX_BATCH:
+                    self.API_Error(400, "Expected a list of at most " + str(MAX_BATCH) + " APDUs")
+                    return
+                # checked before the card runs anything, like a batch
+                apdus = script_items(apdus)
+                if apdus is None:
+                    self.API_Error(400, "Expected hex APDUs, or objects with hex and a list of expected status words")
+                    return
+                options = [body.get(k, True) for k in ('get_response', 'fix_le', 'stop_on_error')]
+                written = any(writes(item['hex']) for item in apdus)
+                try:
+                    responses, stopped = worker.call(worker.card.script, apdus, *options)
+                finally:
+                    if written:
+                        self.pool.forget(worker)
+                self.API_Ok({'responses': responses, 'stopped': stopped})
+            else:
+                self.API_Error(501, "Error")
+        except CardBusy:
+            self.API_Error(503, "Card busy", RETRY_AFTER)
+        except CardUnavailable:
+            self.API_Error(503, "Card not available", RETRY_AFTER)
+        except Exception as e:
+            self.error(params, e)
+        finally:
+            self.measure(params, start)
+
+
+def make_context(cert=PATH):
+    # TLS 1.2+ with forward secrecy and AEAD ciphers only. Session tickets (and
+    # the server session cache) let returning clients resume their TLS session.
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.set_ciphers('ECDHE+AESGCM:ECDHE+CHACHA20')
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    context.options &= ~ssl.OP_NO_TICKET
+    context.load_cert_chain(cert)
+    return context
+
+
+class HTTPServer(ThreadingHTTPServer):
+    request_queue_size = 128
+
+
+class Server:
+    # The https API for the cards of a pool. operations limits the request
+    # types served (version 1 and 3 only have imsi and rand-autn).
+    # A sharded server gives the listening socket (sock), and a router; its
+    # internal listener has no cert (plain HTTP).
+
+    def __init__(self, pool, port=443, cert=PATH, idle_timeout=30, operations=REQUEST_TYPES, address='', sock=None, router=None):
+        handler = type('Handler', (SimpleHTTPRequestHandler,), {'timeout': idle_timeout, 'router': router})
+        self.pool = pool
+        if sock is None:
+            self.httpd = HTTPServer((address, port), partial(handler, pool, operations))
+        else:
+            self.httpd = HTTPServer(sock.getsockname()[:2], partial(handler, pool, operations), bind_and_activate=False)
+            self.httpd.socket = sock
+        if cert is not None:
+            self.httpd.socket = make_context(cert).wrap_socket(self.httpd.socket, server_side=True, do_handshake_on_connect=False)
+
+    @property
+    def server_address(self):
+        return self.httpd.server_address
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,318 @@
+#multi-process server
+#
+# With -P N, a supervisor process forks N server processes (shards). Card i
+# belongs to shard i % N, and only that one opens it. The https socket is
+# opened once by the supervisor and shared: every shard accepts connections
+# on it, so the TLS handshakes and the encoding of the responses use all the
+# cores. A request for a card of another shard (card, imsi or session) is
+# sent to the internal listener of that shard (plain HTTP on 127.0.0.1),
+# and its response relayed. The other requests are served by the shard
+# that got them, with its own cards.
+#
+# A shard that exits is started again by the supervisor, that also tells
+# systemd when all of them are ready.
+
+import http.client
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from .cli import serve, notify, card_specs
+from .pool import Session
+from .server import Server, HTTPServer, RETRY_AFTER
+
+#seconds between the checks of the shards by the supervisor
+CHECK_INTERVAL = 0.2
+
+#seconds before a shard that exited is started again
+RESTART_DELAY = 1
+
+#seconds to wait for the response of another shard
+FORWARD_TIMEOUT = 60
+
+#errors of a kept connection closed by the other shard before it got the
+#request, the only ones after which a request is sent again
+RETRY_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+#headers passed to another shard, and back from its response
+REQUEST_HEADERS = ('Accept', 'Content-Type')
+RESPONSE_HEADERS = ('Content-type', 'Retry-After', 'Vary')
+
+
+class Shard:
+    # One server process, with the cards whose index % count is index.
+    # public is the https socket (shared), internal the listener of this
+    # shard, addresses the internal address of every shard, and warm a
+    # shared flag per shard, set when its cards are warm.
+
+    def __init__(self, index, count, public, internal, addresses, warm):
+        self.index = index
+        self.count = count
+        self.public = public
+        self.internal = internal
+        self.addresses = addresses
+        self.warm = warm
+
+    def server(self, pool, options, operations):
+        # serves the other shards in a thread, returns the https server
+        internal = Server(pool, cert=None, idle_timeout=options.idle_timeout, operations=tuple(operations) + ('cards',), sock=self.internal)
+        threading.Thread(target=internal.serve_forever, name='internal', daemon=True).start()
+        return Server(pool, cert=options.cert, idle_timeout=options.idle_timeout, operations=operations, sock=self.public, router=Router(self, pool, options.idle_timeout))
+
+    def ready(self, pool):
+        available = sum(w.identity is not None for w in pool.workers)
+        print('Shard ' + str(self.index) + ' ready, ' + str(available) + ' of ' + str(len(pool.workers)) + ' cards.')
+        self.warm[self.index] = 1
+
+
+class Router:
+    # Sends the requests for the cards of other shards to them (see
+    # SimpleHTTPRequestHandler.router). The connections to the other shards
+    # are kept, one per handler thread, and opened again before the other
+    # shard closes them (idle_timeout).
+
+    def __init__(self, shard, pool, idle_timeout=30):
+        self.shard = shard
+        self.pool = pool
+        self.idle_timeout = idle_timeout
+        self.local = threading.local()
+        # imsi: shard, for the cards of the other shards
+        self.imsis = {}
+
+    def is_ready(self):
+        return all(self.shard.warm)
+
+    def owner(self, params):
+        # shard of the card of a request, None for this one
+        index = None
+        if 'session' in params:
+            index = Session.card_of(params['session'])
+        elif 'card' in params and params['card'].isdigit():
+            index = int(params['card'])
+        elif 'imsi' in params:
+            if any(w.imsi == params['imsi'] for w in self.pool.workers):
+                return None
+            return self.find(params['imsi'])
+        if index is None or index % self.shard.count == self.shard.index:
+            return None
+        return index % self.shard.count
+
+    def find(self, imsi):
+        # shard of the card with imsi, asked to the other shards when unknown
+        if imsi not in self.imsis:
+            for shard, cards in self.other_cards():
+                for card in cards:
+                    if card.get('imsi') is not None:
+                        self.imsis[card['imsi']] = shard
+        return self.imsis.get(imsi)
+
+    def route(self, handler, params, body=None):
+        # True when the request was sent to another shard (and answered)
+        if params.get('type') == 'cards':
+            return False
+        shard = self.owner(params)
+        if shard is None:
+            return False
+        handler.forwarded = True
+        status = self.forward(handler, shard, body)
+        if status == 404 and 'imsi' in params:
+            self.imsis.pop(params['imsi'], None)  #the card was changed
+        return True
+
+    def connection(self, shard):
+        # (kept connection to shard, whether it was just opened)
+        connections = self.local.__dict__.setdefault('connections', {})
+        used = self.local.__dict__.setdefault('used', {})
+        now = time.monotonic()
+        if shard in connections and now - used[shard] > self.idle_timeout / 2:
+            self.drop(shard)
+        used[shard] = now
+        connection = connections.get(shard)
+        if connection is not None:
+            return connection, False
+        host, port = self.shard.addresses[shard]
+        connection = connections[shard] = http.client.HTTPConnection(host, port, timeout=FORWARD_TIMEOUT)
+        return connection, True
+
+    def drop(self, shard):
+        connection = self.local.__dict__.get('connections', {}).pop(shard, None)
+        if connection is not None:
+            connection.close()
+
+    def request(self, shard, method, path, body=None, headers={}):
+        # The response of shard, None if it can't be reached. A GET on a kept
+        # connection closed by the other side is sent again, once, on a new
+        # one. Other requests (a batch, a script) may have run already, and
+        # nothing is sent again after a timeout.
+        while True:
+            connection, new = self.connection(shard)
+            try:
+                connection.request(method, path, body, headers)
+                return connection.getresponse()
+            except RETRY_ERRORS:
+                self.drop(shard)
+                if new or method != 'GET':
+                    return None
+            except (OSError, http.client.HTTPException):
+                self.drop(shard)
+                return None
+
+    def forward(self, handler, shard, body=None):
+        headers = {k: handler.headers[k] for k in REQUEST_HEADERS if k in handler.headers}
+        if body is not None:
+            headers['Content-Length'] = str(len(body))
+        response = self.request(shard, handler.command, handler.path, body, headers)
+        if response is None:
+            handler.API_Error(503, "Card not available", RETRY_AFTER)
+            return 503
+        handler.status = response.status
+        try:
+            handler.send_response(response.status)
+            for name in RESPONSE_HEADERS:
+                value = response.getheader(name)
+                if value is not None:
+                    handler.send_header(name, value)
+            if response.chunked:
+                # a stream (dump) is relayed as it comes
+                handler.send_header("Transfer-Encoding", "chunked")
+                handler.end_headers()
+                while True:
+                    data = response.read1(65536)
+                    if not data:
+                        break
+                    handler.wfile.write(b'%X\r\n' % len(data) + data + b'\r\n')
+                    handler.wfile.flush()
+                handler.wfile.write(b'0\r\n\r\n')
+            else:
+                data = response.read()
+                handler.send_header("Content-Length", str(len(data)))
+                handler.end_headers()
+                handler.wfile.write(data)
+        except (OSError, http.client.HTTPException):
+            # the response wasn't read to the end, the connection can't be kept
+            self.drop(shard)
+            handler.close_connection = True
+        return response.status
+
+    def get(self, shard, path):
+        # body of a GET to another shard, None if it failed
+        response = self.request(shard, 'GET', path, headers={'Accept': 'application/json'})
+        if response is None:
+            return None
+        try:
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.drop(shard)
+            return None
+        return data.decode('utf-8') if response.status == 200 else None
+
+    def others(self):
+        return [shard for shard in range(self.shard.count) if shard != self.shard.index]
+
+    def other_cards(self):
+        for shard in self.others():
+            body = self.get(shard, '/?type=cards')
+            if body is not None:
+                yield shard, json.loads(body)
+
+    def cards(self, cards):
+        # the cards of all the shards
+        cards = list(cards)
+        for shard, other in self.other_cards():
+            cards += other
+        return sorted(cards, key=lambda card: card['card'])
+
+    def metrics(self, text):
+        # the metrics of all the shards
+        texts = [text]
+        for shard in self.others():
+            body = self.get(shard, '/metrics')
+            if body is not None:
+                texts.append(body)
+        return merge_metrics(texts)
+
+
+def merge_metrics(texts):
+    # one Prometheus text of several, the samples with the same name and
+    # labels added up
+    families = {}
+    for text in texts:
+        name = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split(' ', 3)[2]
+                families.setdefault(name, ([line], {}))
+            elif line.startswith('# TYPE '):
+                if len(families[name][0]) == 1:
+                    families[name][0].append(line)
+            elif line and name is not None:
+                sample, value = line.rsplit(' ', 1)
+                samples = families[name][1]
+                samples[sample] = samples.get(sample, 0) + float(value)
+    lines = []
+    for comments, samples in families.values():
+        lines += comments
+        lines += [sample + ' ' + (str(int(value)) if value.is_integer() else repr(value)) for sample, value in samples.items()]
+    return '\n'.join(lines) + '\n'
+
+
+def supervise(options, operations):
+    # Forks the shards (at most one per card) and starts again the ones that
+    # exit. The sockets are opened here, before the shards, so they share
+    # the https one and know the internal one of each other.
+    count = min(options.processes, len(card_specs(options)))
+    if count <= 1:
+        serve(options, operations)
+        return
+    public = socket.create_server(('', options.port), backlog=HTTPServer.request_queue_size)
+    internals = [socket.create_server(('127.0.0.1', 0), backlog=128) for i in range(count)]
+    addresses = [s.getsockname()[:2] for s in internals]
+    warm = multiprocessing.Array('b', count)
+    shards = {}
+
+    def start(index):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                for i, s in enumerate(internals):
+                    if i != index:
+                        s.close()
+                serve(options, operations, Shard(index, count, public, internals[index], addresses, warm))
+            finally:
+                os._exit(1)
+        shards[pid] = index
+
+    def stop(signum, frame):
+        for pid in list(shards):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(count):
+        start(index)
+    print('Started ' + str(count) + ' processes.')
+    notified = False
+    try:
+        while True:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid in shards:
+                index = shards.pop(pid)
+                warm[index] = 0
+                print('Shard ' + str(index) + ' exited, starting it again.')
+                time.sleep(RESTART_DELAY)
+                start(index)
+            if not notified and all(warm):
+                notified = True
+                print('Ready, ' + str(count) + ' processes.')
+                notify('READY=1\nSTATUS=' + str(count) + ' processes')
+            time.sleep(CHECK_INTERVAL)
+    except KeyboardInterrupt:
+        stop(None, None)
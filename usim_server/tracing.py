@@ -0,0 +1,207 @@
+###########################################################
+#
+#         Request tracing for the USIM https server
+#         -----------------------------------------
+###########################################################
+# Optional spans with the time spent in each stage of a request,
+# written to a file when the request is done (--trace <file>):
+#
+# http.request            the request, from its headers to the response
+#   http.parse            request line and headers
+#   card.queue            waiting for the worker of the card
+#   card.job              the job in the worker
+#     apdu                every APDU (command, lengths, status word)
+#       at.write, at.read the AT+CSIM command of a modem
+#     get-response        GET RESPONSE chaining
+#   serialize             encoding of the response
+# tls.handshake           the TLS handshake of a connection
+#
+# The data of AUTHENTICATE, VERIFY PIN and UNBLOCK PIN is not written,
+# nor any response data (only its length).
+#
+# Formats: jsonl, one span per line, or otlp, one trace per line in
+# the OTLP/JSON format of the OpenTelemetry file exporter (read by the
+# otlpjsonfile receiver of the OpenTelemetry collector).
+###########################################################
+
+import json
+import os
+import threading
+import time
+
+FORMATS = ('jsonl', 'otlp')
+
+#instructions whose command data is key material or a PIN
+SECRET_INS = (0x88, 0x89, 0x20, 0x2C, 0x24, 0x2A)
+
+#OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+
+
+def redact(apdu):
+    # hex of the APDU, with only the header and Lc when its data is secret
+    if len(apdu) > 5 and apdu[1] in SECRET_INS:
+        return bytes(apdu[:5]).hex().upper() + '..'
+    return bytes(apdu).hex().upper()
+
+def redact_at(cli):
+    # AT+CSIM carries an APDU, only its length is kept
+    if cli.upper().startswith('AT+CSIM='):
+        return cli.split(',', 1)[0]
+    return cli
+
+
+class Span:
+
+    __slots__ = ('trace_id', 'span_id', 'parent', 'name', 'start', 'end', 'attributes', 'spans')
+
+    def __init__(self, name, parent, attributes, start=None):
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent = parent
+        self.name = name
+        self.start = time.time_ns() if start is None else start
+        self.end = None
+        self.attributes = attributes
+        # all the spans of the trace, in the order they end (shared with the root)
+        self.spans = parent.spans if parent is not None else []
+
+
+class Tracer:
+    # Spans are only recorded inside a trace (a root span), started by the
+    # server for every request. The current span is kept per thread; a
+    # CardWorker makes the span of the request current while it runs its job.
+
+    def __init__(self):
+        self.file = None
+        self.format = 'jsonl'
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def configure(self, path, format='jsonl'):
+        if format not in FORMATS:
+            raise ValueError('Unknown trace format ' + format)
+        self.format = format
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def current(self):
+        return getattr(self.local, 'span', None)
+
+    def activate(self, span):
+        # makes span current, returns the one it replaces
+        previous = self.current()
+        self.local.span = span
+        return previous
+
+    def start(self, name, root=False, **attributes):
+        # a root span starts a trace (when tracing is configured), the
+        # others are children of the current span, or None outside a trace
+        if self.file is None:
+            return None
+        parent = None if root else self.current()
+        if parent is None and not root:
+            return None
+        span = Span(name, parent, attributes)
+        self.local.span = span
+        return span
+
+    def end(self, span, **attributes):
+        if span is None:
+            return
+        span.end = time.time_ns()
+        span.attributes.update(attributes)
+        span.spans.append(span)
+        self.local.span = span.parent
+        if span.parent is None:
+            self.export(span.spans)
+
+    def record(self, name, parent, start, **attributes):
+        # a span of parent that started at start (time.time_ns()) and ends now
+        if parent is None:
+            return
+        span = Span(name, parent, attributes, start)
+        span.end = time.time_ns()
+        span.spans.append(span)
+
+    def span(self, name, **attributes):
+        return SpanContext(self, name, attributes)
+
+    def export(self, spans):
+        if self.format == 'otlp':
+            lines = [json.dumps(otlp(spans), separators=(',', ':'))]
+        else:
+            lines = [json.dumps(jsonl(span), separators=(',', ':')) for span in spans]
+        with self.lock:
+            try:
+                self.file.write('\n'.join(lines) + '\n')
+                self.file.flush()
+            except (OSError, ValueError):
+                pass
+
+
+class SpanContext:
+    # with tracer.span(name): ... (a no-op outside a trace)
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.value = None
+
+    def __enter__(self):
+        self.value = self.tracer.start(self.name, **self.attributes)
+        return self.value
+
+    def __exit__(self, kind, value, traceback):
+        if kind is not None and self.value is not None:
+            self.value.attributes['error'] = kind.__name__
+        self.tracer.end(self.value)
+        return False
+
+
+def jsonl(span):
+    return {
+        'trace_id': span.trace_id,
+        'span_id': span.span_id,
+        'parent_id': span.parent.span_id if span.parent is not None else None,
+        'name': span.name,
+        'start': span.start,
+        'end': span.end,
+        'duration_ms': (span.end - span.start) / 1e6,
+        'attributes': span.attributes,
+    }
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def otlp(spans):
+    # ExportTraceServiceRequest of one trace
+    items = []
+    for span in spans:
+        item = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': KIND_SERVER if span.parent is None else KIND_INTERNAL,
+            'startTimeUnixNano': str(span.start),
+            'endTimeUnixNano': str(span.end),
+            'attributes': [{'key': k, 'value': otlp_value(v)} for k, v in span.attributes.items()],
+        }
+        if span.parent is not None:
+            item['parentSpanId'] = span.parent.span_id
+        items.append(item)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'usim-https-server'}}]},
+        'scopeSpans': [{'scope': {'name': 'usim_server'}, 'spans': items}],
+    }]}
+
+
+#the tracer used by the servers
+tracer = Tracer()
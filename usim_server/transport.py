@@ -0,0 +1,356 @@
+#transports: how APDUs reach a card
+#
+# A connection has transmit(apdu) -> (data, sw1, sw2), like a pyscard
+# connection. The openers below return one for a modem (AT+CSIM), a
+# pyscard reader, card.USIM or the emulator, and a Connector keeps it
+# (or opens it for every job) for one card.
+
+import os
+import threading
+import time
+
+from .codec import to_hex, to_bytes
+from .metrics import metrics, MeteredConnection, APDUObserver
+from .tracing import tracer, redact_at
+
+#seconds to wait for the final result code of an AT command:
+AT_TIMEOUT = 5
+
+#seconds a kept connection can be idle before it is checked (getATR) on next use:
+HEALTH_CHECK = 5
+
+#seconds requests fail at once (503), after a card could not be opened:
+RETRY_OPEN = 2
+
+#sw1 values meaning that the command reached the intended file/application
+SW1_SELECTED = (0x90, 0x91, 0x61, 0x6C, 0x98, 0x9F)
+
+
+#modem
+class ModemError(Exception):
+    pass
+
+
+class CardUnavailable(Exception):
+    # the card is removed, or could not be opened a moment ago
+    pass
+
+
+class ModemTransport:
+    # AT command channel to a modem. The response is read in bulk and split
+    # in lines as it arrives, until a final result code (OK, ERROR, +CME ERROR,
+    # +CMS ERROR) is received or the command times out.
+    # transmit() sends an APDU through AT+CSIM and returns (data, sw1, sw2)
+    # like the transmit() of a pyscard connection, so the same reader
+    # functions can be used with modems and smartcard readers.
+
+    def __init__(self, port, baudrate=38400, timeout=AT_TIMEOUT):
+        import serial
+        self.port = port
+        self.timeout = timeout
+        self.ser = serial.Serial(port, baudrate, timeout=0.1, xonxoff=True, rtscts=True, dsrdtr=True, exclusive=True)
+        self.buffer = bytearray()
+
+    def close(self):
+        self.ser.close()
+
+    def readline(self, deadline):
+        while True:
+            end = self.buffer.find(b'\n')
+            if end >= 0:
+                line = self.buffer[:end].strip().decode('ascii', 'replace')
+                del self.buffer[:end + 1]
+                return line
+            if time.monotonic() > deadline:
+                raise ModemError('Timeout')
+            # waits for the first byte, then takes everything already received
+            self.buffer += self.ser.read(max(1, self.ser.in_waiting))
+
+    def command(self, cli, timeout=None):
+        # returns the information lines of the response
+        deadline = time.monotonic() + (timeout or self.timeout)
+        self.ser.reset_input_buffer()
+        self.buffer.clear()
+        with tracer.span('at.write', command=redact_at(cli)):
+            self.ser.write(cli.encode() + b'\r\n')
+        with tracer.span('at.read') as span:
+            lines = self.read_response(cli, deadline)
+            if span is not None:
+                span.attributes['response_length'] = sum(len(line) for line in lines)
+        return lines
+
+    def read_response(self, cli, deadline):
+        lines = []
+        while True:
+            line = self.readline(deadline)
+            if line == 'OK':
+                return lines
+            if line == 'ERROR' or line.startswith('+CME ERROR') or line.startswith('+CMS ERROR'):
+                raise ModemError(line)
+            if line and line != cli:  # skips empty lines and the echo
+                lines.append(line)
+
+    def transmit(self, apdu, protocol=None):
+        hexstring = to_hex(apdu)
+        for line in self.command('AT+CSIM=' + str(len(hexstring)) + ',"' + hexstring + '"'):
+            if line.startswith('+CSIM:'):
+                response = to_bytes(line.split(',', 1)[1].strip().strip('"'))
+                if len(response) < 2:
+                    break
+                return response[:-2], response[-2], response[-1]
+        raise ModemError('No +CSIM response')
+
+
+#logical channels
+def channel_cla(cla, channel):
+    # CLA of a command on a logical channel (ETSI TS 102 221 10.1.1), the
+    # other classes (i.e. A0 of GSM) are left as they are
+    if cla & 0x30:
+        return cla
+    if channel < 4:
+        return (cla & (0x80 if cla & 0x40 else 0x8C)) | channel
+    return (cla & 0x80) | 0x40 | (channel - 4)
+
+
+class LogicalChannel:
+    # Sends every APDU on a logical channel of the card (opened with MANAGE
+    # CHANNEL), with the channel number put in its CLA.
+
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def transmit(self, apdu, protocol=None):
+        apdu = list(apdu)
+        apdu[0] = channel_cla(apdu[0], self.channel)
+        return self.connection.transmit(apdu)
+
+
+#card file system state
+class TrackedConnection:
+    # Wraps a pyscard connection or a ModemTransport and remembers the
+    # SELECTs in effect on the card, so that they aren't sent again.
+    # Anything that may change the selection behind our back (raw APDUs)
+    # must call invalidate(), and reset() after a card reset.
+    # aka is the connection used for AKA (see card.aka_connection), None
+    # until the first authentication. status is the sw1, sw2 of the last
+    # SELECT sent.
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.selected = ()
+        self.aka = None
+        self.status = (0x90, 0x00)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def transmit(self, apdu, protocol=None):
+        return self.connection.transmit(apdu)
+
+    def invalidate(self):
+        self.selected = ()
+
+    def reset(self):
+        # the logical channels are closed by a card reset
+        self.invalidate()
+        self.aka = None
+
+    def select(self, path, force=False):
+        # Returns True if the selection was already in effect. When the
+        # current selection is the start of path, only the rest is sent.
+        if not force and self.selected == path:
+            return True
+        start = 0
+        if not force and self.selected == path[:len(self.selected)]:
+            start = len(self.selected)
+        self.selected = ()
+        for i in range(start, len(path)):
+            data, sw1, sw2 = self.connection.transmit(to_bytes(path[i]))
+            self.status = (sw1, sw2)
+            if sw1 not in SW1_SELECTED:
+                return False
+        self.selected = path
+        return False
+
+    def select_and_transmit(self, path, apdu):
+        # If the selection was skipped and the card rejects apdu, something
+        # else may have changed it, so it is done again in full and apdu resent.
+        skipped = self.select(path)
+        data, sw1, sw2 = self.connection.transmit(apdu)
+        if skipped and sw1 not in SW1_SELECTED:
+            self.select(path, force=True)
+            data, sw1, sw2 = self.connection.transmit(apdu)
+        return data, sw1, sw2
+
+
+class USIMConnection:
+    # A card.USIM instance, with getATR() and disconnect() like the others
+
+    def __init__(self, usim):
+        self.usim = usim
+
+    def getATR(self):
+        return self.usim.cardservice.connection.getATR()
+
+    def disconnect(self):
+        self.usim.disconnect()
+
+
+#openers
+def open_modem(port):
+    return TrackedConnection(MeteredConnection(ModemTransport(port), 'modem'))
+
+def open_reader(index):
+    from smartcard.System import readers
+    connection = readers()[int(index)].createConnection()
+    connection.connect()
+    return TrackedConnection(MeteredConnection(connection, 'pyscard'))
+
+def open_usim(index):
+    from card.USIM import USIM
+    usim = USIM(int(index))
+    try:
+        usim.cardservice.connection.addObserver(APDUObserver('card.USIM'))
+    except AttributeError:
+        pass
+    return USIMConnection(usim)
+
+def open_emulator(subscriber, latency=0, auth_latency=None):
+    from .emulator import EmulatedCard
+    return TrackedConnection(MeteredConnection(EmulatedCard(subscriber, latency, auth_latency), 'emulator'))
+
+def reader_name(index):
+    from smartcard.System import readers
+    return str(readers()[int(index)])
+
+def find_reader(index):
+    # name of the reader, or None when it isn't connected
+    try:
+        return reader_name(index)
+    except Exception:
+        return None
+
+def find_port(port):
+    # the port, or None when the device isn't connected (i.e. unplugged modem)
+    if os.path.exists(port):
+        return port
+    try:
+        from serial.tools.list_ports import comports
+        if any(p.device == port for p in comports()):
+            return port
+    except ImportError:
+        pass
+    return None
+
+def smartcard_errors():
+    from smartcard.Exceptions import SmartcardException
+    return (SmartcardException,)
+
+
+class Connector:
+    # The connection to one card. A kept (persistent) connection is opened
+    # on first use, dropped after a connection error or when the card is
+    # removed, and opened again on next use. Without persistent, it is
+    # opened for every job and closed after it (the on-demand model of
+    # version 1).
+    # While the card is removed (removed(), until inserted()), or for
+    # RETRY_OPEN seconds after it could not be opened, calls fail at once
+    # with CardUnavailable instead of waiting for the device.
+    # locate() returns the name of the device when it is connected, or
+    # None (find_reader, find_port). index is the card in the pool, the
+    # card label of the metrics.
+
+    def __init__(self, name, transport, open, persistent=True, errors=(OSError,), locate=None, index=None):
+        self.name = name
+        self.index = index
+        self.transport = transport
+        self.open = open
+        self.persistent = persistent
+        self.errors = errors
+        self.locate = locate
+        self.connection = None
+        self.connected = False
+        self.present = True
+        self.retry_at = 0
+        self.last_used = 0
+        self.lock = threading.Lock()
+
+    def available(self):
+        return self.present and (self.connection is not None or time.monotonic() >= self.retry_at)
+
+    def removed(self):
+        self.present = False
+        self.drop()
+
+    def inserted(self):
+        self.present = True
+        self.retry_at = 0
+        self.invalidate()
+
+    def healthy(self):
+        try:
+            self.connection.getATR()
+            return True
+        except AttributeError:  #modems have no ATR
+            return True
+        except Exception:
+            return False
+
+    def get(self):
+        with self.lock:
+            if not self.present:
+                raise CardUnavailable(self.name)
+            if self.connection is not None and time.monotonic() - self.last_used > HEALTH_CHECK and not self.healthy():
+                self.connection = None
+            if self.connection is None:
+                if time.monotonic() < self.retry_at:
+                    raise CardUnavailable(self.name)
+                try:
+                    self.connection = self.open()
+                except Exception as e:
+                    self.retry_at = time.monotonic() + RETRY_OPEN
+                    raise CardUnavailable(self.name) from e
+                if self.connected and self.persistent:
+                    metrics.inc('usim_card_reconnects_total', (('card', self.index), ('port', self.name)))
+                self.connected = True
+            self.last_used = time.monotonic()
+            return self.connection
+
+    def drop(self):
+        with self.lock:
+            connection, self.connection = self.connection, None
+        if connection is None:
+            return
+        for name in ('disconnect', 'close'):
+            try:
+                getattr(connection, name)()
+                return
+            except AttributeError:
+                continue
+            except Exception:
+                return
+
+    def invalidate(self):
+        # the card was reset: its selection and logical channels are gone
+        connection = self.connection
+        if connection is not None and hasattr(connection, 'reset'):
+            connection.reset()
+
+    def call(self, function, *args):
+        # function(connection, *args), retried once on a new connection
+        # after a connection error
+        try:
+            try:
+                return function(self.get(), *args)
+            except self.errors:
+                if not self.persistent:
+                    raise
+                self.drop()
+                return function(self.get(), *args)
+        finally:
+            if not self.persistent:
+                self.drop()